@@ -0,0 +1,100 @@
+import sys
+import argparse
+import logging
+
+import numpy as np
+from dotenv import load_dotenv
+
+from pcmux_speakers import SpeakerIndex
+from pcmux_audio import read_media_file, read_stdin_audio
+
+load_dotenv()
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+
+class PyannoteEmbedder:
+    # Same embedding model as tee_transcribe_annote.py (EMBEDDING_MODEL)
+    def __init__(self):
+        import torch
+        from pyannote.audio import Inference
+        from pcmux_diarize import diarization_model_names
+        self.torch = torch
+        self.model = diarization_model_names()[1]
+        self.inference = Inference(self.model, window="whole")
+
+    def __call__(self, audio_np, sample_rate):
+        waveform = self.torch.from_numpy(audio_np).unsqueeze(0)
+        return np.asarray(self.inference({"waveform": waveform, "sample_rate": sample_rate}))
+
+
+class TitaNetEmbedder:
+    # Same embedding model as tee_transcribe_nemo.py
+    def __init__(self):
+        import torch
+        import nemo.collections.asr as nemo_asr
+        self.torch = torch
+        self.model = "titanet_large"
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.spk_model = nemo_asr.models.EncDecSpeakerLabelModel.from_pretrained(self.model).to(self.device)
+        self.spk_model.eval()
+
+    def __call__(self, audio_np, sample_rate):
+        signal = self.torch.from_numpy(audio_np).float().unsqueeze(0).to(self.device)
+        length = self.torch.tensor([signal.shape[-1]], device=self.device)
+        with self.torch.no_grad():
+            _, emb = self.spk_model(input_signal=signal, input_signal_length=length)
+        return emb[0].cpu().numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enroll known speakers for the local transcribers.")
+    parser.add_argument("index", help="Speaker index file (.npz), created if missing")
+    parser.add_argument("name", nargs="?", help="Name reported as the speaker")
+    parser.add_argument("files", nargs="*", help="Media files with only this speaker talking (default: PCMux audio on stdin)")
+    parser.add_argument("-b", "--backend", choices=["pyannote", "titanet"], default="pyannote",
+                        help="Embedding model: pyannote for tee_transcribe_annote.py, titanet for tee_transcribe_nemo.py")
+    parser.add_argument("--sample-rate", type=int, default=16000, help="Sample rate for processing audio")
+    parser.add_argument("-l", "--list", action="store_true", help="List enrolled speakers")
+    parser.add_argument("-r", "--remove", action="store_true", help="Remove the named speaker")
+    args = parser.parse_args()
+
+    index = SpeakerIndex.load(args.index)
+
+    if args.list:
+        print(f"{args.index}: {index.model}")
+        for name, count in zip(index.names, index.counts):
+            print(f"{name}\t{int(count)} samples")
+        return
+
+    if not args.name:
+        parser.error("a speaker name is required")
+
+    if args.remove:
+        if args.name not in index.names:
+            parser.error(f"{args.name} is not enrolled in {args.index}")
+        index.remove(args.name)
+        index.save(args.index)
+        logging.info(f"Removed {args.name}")
+        return
+
+    embedder = PyannoteEmbedder() if args.backend == "pyannote" else TitaNetEmbedder()
+    if index.model is None:
+        index.model = embedder.model
+    elif index.model != embedder.model:
+        logging.error(f"{args.index} was enrolled with {index.model}, not {embedder.model}")
+        sys.exit(1)
+
+    recordings = [read_media_file(path, args.sample_rate) for path in args.files] or [read_stdin_audio()]
+    for audio_np in recordings:
+        if len(audio_np) < args.sample_rate:
+            logging.warning("Skipping recording shorter than one second")
+            continue
+        index.enroll(args.name, embedder(audio_np, args.sample_rate))
+
+    index.save(args.index)
+    logging.info(f"Enrolled {args.name}, {len(index.names)} speakers in {args.index}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import os
+import re
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import logging
+from collections import deque
+from urllib.parse import urlparse
+
+import aiohttp
+import numpy as np
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+SAMPLE_RATE = 24000
+DELTA_SECONDS = 0.02
+TIMESTAMP = re.compile(r"\[t=(\d+\.\d+)\]")
+WEBCHAT = "sink_webchat.py"
+# Matches COMMIT_INTERVAL in sink_webchat.html
+WEBCHAT_COMMIT_INTERVAL = 5.0
+
+
+def synthetic_audio(speech=4.0, silence=2.0):
+    # One cycle of voiced-sounding harmonics followed by faint noise, as PCMux lines
+    rng = np.random.default_rng(0)
+    t = np.arange(int(speech * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 6)) * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t))
+    quiet = rng.normal(0, 0.001, int(silence * SAMPLE_RATE))
+    samples = (np.concatenate([voiced * 0.3, quiet]) * 32767).astype(np.int16)
+
+    size = int(DELTA_SECONDS * SAMPLE_RATE)
+    lines = []
+    for start in range(0, len(samples) - size + 1, size):
+        delta = base64.b64encode(samples[start:start + size].tobytes()).decode("ascii")
+        lines.append((json.dumps({"type": "pcmux.audio.delta", "delta": delta}) + "\n").encode())
+    return lines
+
+
+async def feed(process, lines, duration, speed, result):
+    interval = DELTA_SECONDS / speed
+    start = time.time()
+    count = int(duration / DELTA_SECONDS)
+    for i in range(count):
+        process.stdin.write(lines[i % len(lines)])
+        before = time.time()
+        await process.stdin.drain()
+        result["max_stall"] = max(result["max_stall"], time.time() - before)
+        result["audio_seconds"] += DELTA_SECONDS
+        delay = start + (i + 1) * interval - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    process.stdin.close()
+
+
+async def collect(process, result, verbose):
+    while True:
+        line = await process.stdout.readline()
+        if not line:
+            break
+        text = line.decode(errors="replace").rstrip()
+        if verbose:
+            logging.info(f"[{result['instance']}] {text}")
+        match = TIMESTAMP.search(text)
+        if match:
+            result["latencies"].append(time.time() - float(match.group(1)))
+        elif text.startswith("Reconnected"):
+            result["reconnects"] += 1
+
+
+async def browse(port, result, ask_interval):
+    # Stands in for sink_webchat.html: commits audio while it is being appended and asks
+    # a question every ask_interval seconds
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                ws = await session.ws_connect(f"http://127.0.0.1:{port}/ws")
+                break
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+        else:
+            logging.error(f"Instance {result['instance']} web interface never came up on port {port}")
+            return
+        last_commit = last_ask = time.time()
+        async with ws:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                event = json.loads(msg.data)
+                event_type = event.get("type")
+                now = time.time()
+                if event_type == "input_audio_buffer.appended":
+                    if now - last_commit >= WEBCHAT_COMMIT_INTERVAL:
+                        await ws.send_json({"type": "input_audio_buffer.commit"})
+                        last_commit = now
+                    if ask_interval and now - last_ask >= ask_interval:
+                        await ws.send_json({"type": "response.create",
+                                            "response": {"instructions": "Summarize the meeting so far."}})
+                        result["asked"].append(now)
+                        last_ask = now
+                elif event_type == "conversation.item.input_audio_transcription.completed":
+                    match = TIMESTAMP.search(event.get("transcript", ""))
+                    if match:
+                        result["latencies"].append(now - float(match.group(1)))
+                elif event_type == "response.done" and result["asked"]:
+                    result["latencies"].append(now - result["asked"].popleft())
+
+
+async def run_instance(instance, args, lines, env):
+    result = {"instance": instance, "audio_seconds": 0.0, "max_stall": 0.0, "latencies": [], "reconnects": 0,
+              "asked": deque()}
+    sink_args = list(args.sink_args)
+    browser = None
+    if args.sink == WEBCHAT:
+        port = args.webchat_port + instance
+        sink_args += ["--port", str(port)]
+        browser = asyncio.create_task(browse(port, result, args.ask_interval))
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, args.sink, *sink_args, stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE, env=env)
+    collector = asyncio.create_task(collect(process, result, args.verbose))
+    try:
+        await feed(process, lines, args.duration, args.speed, result)
+    except (BrokenPipeError, ConnectionResetError):
+        logging.error(f"Instance {instance} exited early")
+    if browser:
+        # The web server keeps running after its input ends, wait for open questions then stop it
+        deadline = time.time() + args.grace
+        while result["asked"] and time.time() < deadline and process.returncode is None:
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(min(WEBCHAT_COMMIT_INTERVAL / 5, args.grace))
+        stopped = process.returncode is None
+        if stopped:
+            process.terminate()
+        await process.wait()
+        browser.cancel()
+        await asyncio.gather(browser, return_exceptions=True)
+        result["returncode"] = 0 if stopped else process.returncode
+    else:
+        try:
+            await asyncio.wait_for(process.wait(), args.grace)
+        except asyncio.TimeoutError:
+            process.terminate()
+            await process.wait()
+        result["returncode"] = process.returncode
+    await collector
+    return result
+
+
+async def fetch_stats(url):
+    parsed = urlparse(url)
+    scheme = "https" if parsed.scheme == "wss" else "http"
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{scheme}://{parsed.netloc}/stats") as response:
+                return await response.json()
+    except aiohttp.ClientError as e:
+        logging.warning(f"No server stats from {parsed.netloc}: {e}")
+        return None
+
+
+async def run(args):
+    lines = synthetic_audio(args.speech, args.silence)
+    env = dict(os.environ, OPENAI_REALTIME_URL=args.url, PYTHONUNBUFFERED="1")
+    env.setdefault("OPENAI_API_KEY", "mock")
+
+    started = time.time()
+    results = await asyncio.gather(*(run_instance(i, args, lines, env) for i in range(args.instances)))
+    elapsed = time.time() - started
+
+    latencies = np.array([latency for result in results for latency in result["latencies"]])
+    summary = {
+        "sink": args.sink,
+        "instances": args.instances,
+        "elapsed": round(elapsed, 2),
+        "audio_seconds": round(sum(result["audio_seconds"] for result in results), 2),
+        "responses": len(latencies),
+        "reconnects": sum(result["reconnects"] for result in results),
+        "failed": sum(1 for result in results if result["returncode"] not in (0, None)),
+        "max_stall": round(max(result["max_stall"] for result in results), 3),
+    }
+    if len(latencies):
+        summary.update({
+            "latency_p50": round(float(np.percentile(latencies, 50)), 3),
+            "latency_p95": round(float(np.percentile(latencies, 95)), 3),
+            "latency_max": round(float(latencies.max()), 3),
+        })
+    summary["server"] = await fetch_stats(args.url)
+    print(json.dumps(summary, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drive several Realtime sink processes with synthetic PCMux audio, usually against mock_realtime.py.",
+        epilog="Arguments after -- are passed to each sink, e.g. -- --silence-gate energy")
+    parser.add_argument("--sink", default="sink_observe.py", choices=["sink_observe.py", "sink_transcribe.py", WEBCHAT],
+                        help="Sink script to run (default: sink_observe.py)")
+    parser.add_argument("-n", "--instances", type=int, default=10, help="Concurrent sink processes (default: 10)")
+    parser.add_argument("-d", "--duration", type=float, default=60.0, help="Seconds of audio per instance (default: 60)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Multiple of real time to send audio at (default: 1.0)")
+    parser.add_argument("--speech", type=float, default=4.0, help="Seconds of speech per synthetic cycle (default: 4.0)")
+    parser.add_argument("--silence", type=float, default=2.0, help="Seconds of silence per synthetic cycle (default: 2.0)")
+    parser.add_argument("--grace", type=float, default=15.0,
+                        help="Seconds to wait for each sink to finish after its input ends (default: 15)")
+    parser.add_argument("--url", default="ws://127.0.0.1:8089/v1/realtime",
+                        help="Realtime endpoint given to the sinks (default: mock_realtime.py on localhost)")
+    parser.add_argument("--webchat-port", type=int, default=8100,
+                        help="Web port of the first sink_webchat.py instance, the others count up from it (default: 8100)")
+    parser.add_argument("--ask-interval", type=float, default=10.0,
+                        help="Seconds between questions each sink_webchat.py browser asks, 0 for none (default: 10)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every line the sinks print")
+    parser.add_argument("sink_args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.sink_args[:1] == ["--"]:
+        args.sink_args = args.sink_args[1:]
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
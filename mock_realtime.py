@@ -0,0 +1,182 @@
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import asyncio
+import argparse
+import logging
+
+import aiohttp
+from aiohttp import web
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+BYTES_PER_SECOND = {"pcm16": 48000, "g711_ulaw": 8000, "g711_alaw": 8000}
+
+
+def event_id():
+    return f"event_{uuid.uuid4().hex[:16]}"
+
+
+class MockSession:
+    # The subset of the Realtime API protocol used by the PCMux sinks. Responses
+    # carry the commit time as [t=...] so clients can measure end-to-end latency
+    def __init__(self, ws, stats, latency, jitter, vad_interval):
+        self.ws = ws
+        self.stats = stats
+        self.latency = latency
+        self.jitter = jitter
+        self.vad_interval = vad_interval
+        self.session = {"modalities": ["text", "audio"], "input_audio_format": "pcm16", "turn_detection": None}
+        self.buffered = 0
+        self.total = 0
+        self.vad_start = 0
+        self.committed_at = None
+        self.tasks = set()
+
+    def bytes_per_second(self):
+        return BYTES_PER_SECOND.get(self.session.get("input_audio_format"), 48000)
+
+    async def send(self, event):
+        event["event_id"] = event_id()
+        await self.ws.send_json(event)
+
+    def later(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def delay(self):
+        await asyncio.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+
+    async def handle(self, event):
+        event_type = event.get("type")
+        if event_type == "session.update":
+            self.session.update(event.get("session", {}))
+            await self.send({"type": "session.updated", "session": self.session})
+        elif event_type == "input_audio_buffer.append":
+            size = len(base64.b64decode(event.get("audio", "")))
+            self.buffered += size
+            self.total += size
+            self.stats["appends"] += 1
+            self.stats["audio_seconds"] += size / self.bytes_per_second()
+            turn_detection = self.session.get("turn_detection") or {}
+            if turn_detection.get("type") == "server_vad" and \
+                    self.total - self.vad_start >= self.vad_interval * self.bytes_per_second():
+                await self.server_turn()
+        elif event_type == "input_audio_buffer.commit":
+            await self.commit()
+        elif event_type == "input_audio_buffer.clear":
+            self.buffered = 0
+            await self.send({"type": "input_audio_buffer.cleared"})
+        elif event_type == "response.create":
+            self.later(self.respond(self.committed_at or time.time()))
+        else:
+            self.stats["unhandled"] += 1
+            logging.debug(f"Unhandled client event {event_type}")
+
+    async def server_turn(self):
+        # Every vad_interval seconds of audio counts as one spoken turn
+        rate = self.bytes_per_second()
+        await self.send({"type": "input_audio_buffer.speech_started",
+                         "audio_start_ms": self.vad_start * 1000 // rate})
+        await self.send({"type": "input_audio_buffer.speech_stopped", "audio_end_ms": self.total * 1000 // rate})
+        self.vad_start = self.total
+        await self.commit()
+        self.later(self.respond(self.committed_at))
+
+    async def commit(self):
+        if self.buffered == 0:
+            await self.send({"type": "error", "error": {"type": "invalid_request_error",
+                                                        "message": "Error committing input audio buffer: buffer is empty"}})
+            return
+        seconds = self.buffered / self.bytes_per_second()
+        item_id = f"item_{uuid.uuid4().hex[:16]}"
+        self.buffered = 0
+        self.committed_at = time.time()
+        self.stats["commits"] += 1
+        await self.send({"type": "input_audio_buffer.committed", "item_id": item_id})
+        if self.session.get("input_audio_transcription"):
+            self.later(self.transcribe(item_id, seconds, self.committed_at))
+
+    async def transcribe(self, item_id, seconds, committed_at):
+        await self.delay()
+        await self.send({"type": "conversation.item.input_audio_transcription.completed", "item_id": item_id,
+                         "content_index": 0, "transcript": f"mock transcript of {seconds:.2f}s [t={committed_at:.3f}]"})
+
+    async def respond(self, committed_at):
+        response_id = f"resp_{uuid.uuid4().hex[:16]}"
+        await self.send({"type": "response.created", "response": {"id": response_id, "status": "in_progress"}})
+        await self.delay()
+        text = f"mock response [t={committed_at:.3f}]"
+        await self.send({"type": "response.done", "response": {
+            "id": response_id, "status": "completed",
+            "output": [{"type": "message", "role": "assistant", "content": [{"type": "text", "text": text}]}]}})
+        self.stats["responses"] += 1
+        self.stats["latency_total"] += time.time() - committed_at
+
+
+async def realtime_handler(request):
+    app = request.app
+    ws = web.WebSocketResponse(max_msg_size=0)
+    await ws.prepare(request)
+    stats = app['stats']
+    stats["connections"] += 1
+    stats["active"] += 1
+    session = MockSession(ws, stats, app['latency'], app['jitter'], app['vad_interval'])
+    await session.send({"type": "session.created", "session": session.session})
+    try:
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                await session.handle(json.loads(msg.data))
+            # Drop a connection now and then to exercise client reconnects
+            if app['drop_rate'] and random.random() < app['drop_rate']:
+                stats["dropped"] += 1
+                break
+    finally:
+        for task in list(session.tasks):
+            task.cancel()
+        stats["active"] -= 1
+        await ws.close()
+    return ws
+
+
+async def stats_handler(request):
+    stats = dict(request.app['stats'])
+    stats["mean_latency"] = stats["latency_total"] / stats["responses"] if stats["responses"] else None
+    stats["uptime"] = time.time() - request.app['started']
+    return web.json_response(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI Realtime API, for testing the PCMux sinks.")
+    parser.add_argument("--port", type=int, default=8089, help="Port to listen on (default: 8089)")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before each response (default: 0.5)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Random +/- seconds added to the latency (default: 0.1)")
+    parser.add_argument("--vad-interval", type=float, default=5.0,
+                        help="Seconds of audio per turn when a client uses server_vad (default: 5.0)")
+    parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="Probability of dropping the connection after each client event (default: 0)")
+    args = parser.parse_args()
+
+    app = web.Application()
+    app['latency'] = args.latency
+    app['jitter'] = args.jitter
+    app['vad_interval'] = args.vad_interval
+    app['drop_rate'] = args.drop_rate
+    app['started'] = time.time()
+    app['stats'] = {"connections": 0, "active": 0, "dropped": 0, "appends": 0, "audio_seconds": 0.0, "commits": 0,
+                    "responses": 0, "latency_total": 0.0, "unhandled": 0}
+    app.add_routes([
+        web.get('/v1/realtime', realtime_handler),
+        web.get('/stats', stats_handler),
+    ])
+
+    logging.info(f"Mock Realtime API at ws://127.0.0.1:{args.port}/v1/realtime, stats at /stats")
+    web.run_app(app, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import sys
+import json
+import base64
+import logging
+
+import numpy as np
+
+
+def read_media_file(path, sample_rate):
+    import av
+    container = av.open(path)
+    resampler = av.AudioResampler(format='s16', layout='mono', rate=sample_rate)
+    parts = []
+    for frame in container.decode(audio=0):
+        for resampled_frame in resampler.resample(frame):
+            parts.append(resampled_frame.to_ndarray().reshape(-1))
+    container.close()
+    samples = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int16)
+    return samples.astype(np.float32) / 32768.0
+
+
+def read_stdin_audio():
+    # All PCMux audio deltas on stdin until EOF
+    audio_bytes = bytearray()
+    for line in sys.stdin:
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            logging.debug("Received non-JSON message.")
+            continue
+        if message.get("type") == "pcmux.audio.delta" and message.get("delta"):
+            audio_bytes.extend(base64.b64decode(message["delta"]))
+    return np.frombuffer(audio_bytes, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def read_all_audio(input_file, sample_rate):
+    # A whole recording as float32 samples, from a media file or PCMux on stdin
+    if input_file:
+        return read_media_file(input_file, sample_rate)
+    return read_stdin_audio()
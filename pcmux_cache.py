@@ -0,0 +1,88 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+
+class ResultCache:
+    # Content-addressed JSON results on disk, evicting least recently used entries
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self.entries())
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "r") as f:
+                value = json.load(f)
+            # Reads refresh the entry for LRU eviction
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(value)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Trim to 90% of the limit so eviction does not run on every put
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(size for _, _, size in entries)
+        removed = 0
+        for path, _, size in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            removed += 1
+        logging.debug(f"Cache evicted {removed} entries, {self.size} bytes remain")
+
+    def stats(self):
+        return f"cache hits {self.hits}, misses {self.misses}, {self.size / 1e6:.1f} MB"
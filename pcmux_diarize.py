@@ -0,0 +1,242 @@
+import os
+import math
+import logging
+import threading
+
+import numpy as np
+import torch
+
+# Pyannote Audio: https://github.com/pyannote/pyannote-audio
+from pyannote.audio import Inference, Pipeline
+
+
+# Embedding frames of the incremental diarizer. A window overlap of at least a frame plus
+# a step always contains a whole frame embedded with the previous window
+FRAME_DURATION = 1.5
+FRAME_STEP = 0.75
+REUSE_OVERLAP = FRAME_DURATION + FRAME_STEP
+
+
+def diarization_model_names():
+    return (os.getenv("DIARIZATION_MODEL", "pyannote/speaker-diarization"),
+            os.getenv("EMBEDDING_MODEL", "pyannote/embedding"))
+
+
+def load_diarization_models():
+    diarization_model, embedding_model = diarization_model_names()
+    pipeline = Pipeline.from_pretrained(diarization_model)
+    embedding = Inference(embedding_model, window="whole")
+    return pipeline, embedding
+
+
+class CentroidStore:
+    def __init__(self, threshold=0.5, index=None):
+        self.threshold = threshold
+        # Optional SpeakerIndex naming the centroids that match enrolled speakers
+        self.index = index
+        self.labels = []
+        self.centroids = None
+        self.counts = None
+
+    def assign(self, embeddings: np.ndarray, weights=None) -> list:
+        # Match a window's local speakers against the session centroids, one-to-one
+        embeddings = embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-9)
+        if weights is None:
+            weights = np.ones(len(embeddings))
+        assigned = [None] * len(embeddings)
+
+        if self.labels:
+            similarity = embeddings @ self.centroids.T
+            used = set()
+            for flat in np.argsort(-similarity, axis=None):
+                local, known = np.unravel_index(flat, similarity.shape)
+                if similarity[local, known] < self.threshold:
+                    break
+                if assigned[local] is not None or known in used:
+                    continue
+                assigned[local] = int(known)
+                used.add(int(known))
+
+        for local, known in enumerate(assigned):
+            if known is None:
+                assigned[local] = self.add(embeddings[local], weights[local])
+            else:
+                self.update(known, embeddings[local], weights[local])
+
+        labels = [self.labels[known] for known in assigned]
+        if self.index is not None:
+            names = self.index.match(self.centroids[assigned])
+            labels = [name or label for name, label in zip(names, labels)]
+        return labels
+
+    def add(self, embedding: np.ndarray, weight: float) -> int:
+        self.labels.append(f"SPEAKER_{len(self.labels):02d}")
+        if self.centroids is None:
+            self.centroids = embedding[np.newaxis, :].copy()
+            self.counts = np.array([weight], dtype=np.float64)
+        else:
+            self.centroids = np.vstack([self.centroids, embedding])
+            self.counts = np.append(self.counts, weight)
+        return len(self.labels) - 1
+
+    def update(self, index: int, embedding: np.ndarray, weight: float):
+        count = self.counts[index]
+        centroid = (self.centroids[index] * count + embedding * weight) / (count + weight)
+        self.centroids[index] = centroid / (np.linalg.norm(centroid) + 1e-9)
+        self.counts[index] = count + weight
+
+
+class IncrementalDiarizer:
+    def __init__(self, pipeline, embedding, sample_rate=16000, threshold=0.5,
+                 frame_duration=FRAME_DURATION, frame_step=FRAME_STEP, lock=None, index=None):
+        self.pipeline = pipeline
+        self.embedding = embedding
+        # Serializes model inference when the models are shared between diarizers
+        self.lock = lock or threading.Lock()
+        self.sample_rate = sample_rate
+        self.frame_size = int(frame_duration * sample_rate)
+        self.frame_step = int(frame_step * sample_rate)
+        self.speakers = CentroidStore(threshold, index)
+        self.cache_tag = "|".join(diarization_model_names() + (str(self.frame_size), str(self.frame_step)))
+
+        # Per-frame embeddings keyed by absolute frame index, so overlapping
+        # audio shared with the previous window is only embedded once
+        self.frames = {}
+
+    def frame_embeddings(self, audio_np: np.ndarray, offset: int) -> dict:
+        first = math.ceil(offset / self.frame_step)
+        last = (offset + len(audio_np) - self.frame_size) // self.frame_step
+        indexes = range(first, last + 1)
+
+        for index in [i for i in self.frames if i < first]:
+            del self.frames[index]
+
+        missing = [i for i in indexes if i not in self.frames]
+        if missing:
+            crops = []
+            for index in missing:
+                start = index * self.frame_step - offset
+                crops.append(torch.from_numpy(audio_np[start:start + self.frame_size]).unsqueeze(0))
+            with self.lock, torch.no_grad():
+                embeddings = self.embedding.infer(torch.stack(crops))
+            for index, emb in zip(missing, embeddings):
+                self.frames[index] = emb
+            logging.debug(f"Embedded {len(missing)} new frames, {len(indexes) - len(missing)} cached")
+
+        return {i: self.frames[i] for i in indexes}
+
+    def speaker_embedding(self, audio_np: np.ndarray, offset: int, turns: list, frames: dict):
+        # Average the cached frames centered inside this speaker's turns
+        selected = []
+        for index, emb in frames.items():
+            center = index * self.frame_step + self.frame_size // 2
+            if any(start <= center < end for start, end in turns) and not np.isnan(emb).any():
+                selected.append(emb)
+        if selected:
+            return np.mean(selected, axis=0), len(selected)
+
+        # Turns shorter than a frame: embed the concatenated speech directly
+        speech = np.concatenate([audio_np[start - offset:end - offset] for start, end in turns])
+        if len(speech) == 0:
+            return None, 0
+        with self.lock, torch.no_grad():
+            emb = self.embedding({"waveform": torch.from_numpy(speech).unsqueeze(0), "sample_rate": self.sample_rate})
+        if np.isnan(emb).any():
+            return None, 0
+        return emb, 1
+
+    def label(self, audio_np: np.ndarray, offset: int) -> str:
+        # Speaker of a single-speaker span, matched against the session centroids
+        frames = self.frame_embeddings(audio_np, offset)
+        emb, weight = self.speaker_embedding(audio_np, offset, [(offset, offset + len(audio_np))], frames)
+        if emb is None:
+            return "UNKNOWN"
+        return self.speakers.assign(emb[np.newaxis, :], np.array([weight], dtype=np.float64))[0]
+
+    def diarize_full(self, audio_np: np.ndarray, offset=0) -> list:
+        # Whole recording in one pass, the pipeline's own clustering is global
+        audio_tensor = torch.from_numpy(audio_np).unsqueeze(0)
+        file = {"waveform": audio_tensor, "sample_rate": self.sample_rate}
+        with self.lock:
+            annotation = self.pipeline(file)
+
+        # Speakers are embedded with the same model as enrolled speakers, the pipeline's
+        # internal centroids live in a different embedding space
+        labels = annotation.labels()
+        embeddings = []
+        weights = []
+        for label in labels:
+            turns = [(offset + int(segment.start * self.sample_rate), offset + int(segment.end * self.sample_rate))
+                     for segment in annotation.label_timeline(label)]
+            emb, weight = self.speaker_embedding(audio_np, offset, turns, {})
+            embeddings.append(emb)
+            weights.append(weight)
+        found = [i for i, emb in enumerate(embeddings) if emb is not None]
+        mapping = {}
+        if found:
+            names = self.speakers.assign(np.stack([embeddings[i] for i in found]),
+                                         np.array([weights[i] for i in found], dtype=np.float64))
+            mapping = {labels[i]: name for i, name in zip(found, names)}
+
+        segments = []
+        for segment, _, speaker in annotation.itertracks(yield_label=True):
+            start = offset + int(segment.start * self.sample_rate)
+            end = offset + int(segment.end * self.sample_rate)
+            if end > start:
+                segments.append((start, end, mapping.get(speaker, speaker)))
+        segments.sort(key=lambda x: x[0])
+        return segments
+
+    def diarize_window(self, audio_np: np.ndarray, offset: int) -> dict:
+        audio_tensor = torch.from_numpy(audio_np).unsqueeze(0)
+        with self.lock:
+            annotation = self.pipeline({"waveform": audio_tensor, "sample_rate": self.sample_rate})
+
+        # Absolute sample ranges per local label
+        turns = {}
+        for segment, _, speaker in annotation.itertracks(yield_label=True):
+            start = offset + int(segment.start * self.sample_rate)
+            end = offset + int(segment.end * self.sample_rate)
+            if end > start:
+                turns.setdefault(speaker, []).append((start, end))
+
+        # Window-local result with offsets relative to the window, so it can be cached
+        result = {"turns": {}, "embeddings": {}, "weights": {}}
+        if not turns:
+            return result
+        frames = self.frame_embeddings(audio_np, offset)
+        for speaker, speaker_turns in turns.items():
+            result["turns"][speaker] = [(start - offset, end - offset) for start, end in speaker_turns]
+            emb, weight = self.speaker_embedding(audio_np, offset, speaker_turns, frames)
+            if emb is not None:
+                result["embeddings"][speaker] = emb.tolist()
+                result["weights"][speaker] = weight
+        return result
+
+    def diarize(self, audio_np: np.ndarray, offset: int, cache=None) -> list:
+        result = None
+        if cache is not None:
+            key = cache.key("diarize", self.cache_tag, str(self.sample_rate), audio_np.tobytes())
+            result = cache.get(key)
+        if result is None:
+            result = self.diarize_window(audio_np, offset)
+            if cache is not None:
+                cache.put(key, result)
+
+        mapping = {}
+        local_labels = list(result["embeddings"])
+        if local_labels:
+            embeddings = np.array([result["embeddings"][speaker] for speaker in local_labels], dtype=np.float32)
+            weights = np.array([result["weights"][speaker] for speaker in local_labels], dtype=np.float64)
+            global_labels = self.speakers.assign(embeddings, weights)
+            mapping = dict(zip(local_labels, global_labels))
+            logging.debug(f"Speaker mapping: {mapping}")
+
+        segments = []
+        for speaker, speaker_turns in result["turns"].items():
+            # Speakers we could not embed cannot be matched across windows
+            label = mapping.get(speaker, "UNKNOWN")
+            for start, end in speaker_turns:
+                segments.append((offset + start, offset + end, label))
+        segments.sort(key=lambda x: x[0])
+        return segments
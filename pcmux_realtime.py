@@ -0,0 +1,226 @@
+import json
+import time
+import asyncio
+from collections import deque
+
+import aiohttp
+
+from pcmux_uplink import AudioCoalescer, UplinkEncoder, append_message, uplink_bytes_per_second
+
+RELEASE_EVENTS = ("input_audio_buffer.commit", "input_audio_buffer.clear")
+
+
+class RealtimeClient:
+    # Realtime API connection that reconnects with backoff, re-sends the session
+    # configuration and replays audio the server has not consumed yet
+    def __init__(self, url, api_key, session, on_event, log, replay_seconds=10.0, sample_rate=24000,
+                 append_ms=200, max_latency=0.3, max_backoff=30.0, close_timeout=10.0, stats_interval=10.0,
+                 audio_format="pcm16", tag=""):
+        self.url = url
+        self.headers = {"Authorization": f"Bearer {api_key}", "OpenAI-Beta": "realtime=v1"}
+        self.session = dict(session, input_audio_format=audio_format)
+        self.on_event = on_event
+        self.log = log
+        # Prefix for status lines when several clients share one output
+        self.tag = tag
+        self.encoder = UplinkEncoder(audio_format, sample_rate) if audio_format != "pcm16" else None
+        # Positions and sizes below are in uplink bytes, after encoding
+        self.bytes_per_second = uplink_bytes_per_second(audio_format, sample_rate)
+        self.replay_bytes = int(replay_seconds * self.bytes_per_second)
+        self.min_bytes = int(self.bytes_per_second * append_ms / 1000)
+        self.max_latency = max_latency
+        self.max_backoff = max_backoff
+        self.close_timeout = close_timeout
+        self.stats_interval = stats_interval
+        # (end position, size, base64) of audio sent or waiting, up to replay_seconds
+        self.ring = deque()
+        self.ring_size = 0
+        self.position = 0
+        self.session_start = 0
+        self.queue = None
+        self.connected = False
+        self.stopped = False
+        self.pending_responses = 0
+        self.requested_responses = 0
+        self.disconnected_at = None
+        self.dropped_bytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats_start = time.time()
+        self.sent_appends = 0
+        self.sent_bytes = 0
+        self.max_depth = 0
+
+    def append_audio(self, delta_b64):
+        if self.encoder:
+            delta_b64 = self.encoder.encode(delta_b64)
+            if not delta_b64:
+                return
+        size = len(delta_b64) // 4 * 3
+        self.position += size
+        self.ring.append((self.position, size, delta_b64))
+        self.ring_size += size
+        while self.ring_size > self.replay_bytes:
+            _, dropped, _ = self.ring.popleft()
+            self.ring_size -= dropped
+            if not self.connected:
+                self.dropped_bytes += dropped
+        if self.connected:
+            self.queue.put_nowait(("audio", self.position, delta_b64))
+
+    def send_event(self, event):
+        # Events are not replayed; uncommitted audio stays in the ring for the next commit
+        if not self.connected:
+            self.log(f"Not connected, dropped {event['type']}")
+            return
+        self.queue.put_nowait(("event", None, event))
+
+    def stop(self):
+        self.stopped = True
+        if self.connected:
+            self.queue.put_nowait(("stop", None, None))
+
+    def release(self, position):
+        while self.ring and self.ring[0][0] <= position:
+            _, size, _ = self.ring.popleft()
+            self.ring_size -= size
+
+    def start_replay(self):
+        # Whatever the old connection still had queued is also in the ring
+        self.queue = asyncio.Queue()
+        self.session_start = self.ring[0][0] - self.ring[0][1] if self.ring else self.position
+        for item in self.ring:
+            self.queue.put_nowait(("audio", item[0], item[2]))
+        self.connected = True
+        self.pending_responses = 0
+        self.requested_responses = 0
+        self.idle.set()
+
+    def report(self):
+        elapsed = time.time() - self.stats_start
+        if elapsed < self.stats_interval:
+            return
+        self.log(f"Uplink: {self.sent_appends / elapsed:.1f} appends/s, {self.sent_bytes / elapsed / 1000:.1f} KB/s, "
+                 f"queue depth {self.queue.qsize()} (max {self.max_depth})")
+        self.reset_stats()
+
+    async def flush(self, ws, coalescer):
+        audio_b64 = coalescer.flush()
+        if audio_b64:
+            await ws.send_str(append_message(audio_b64))
+            self.sent_appends += 1
+            self.sent_bytes += len(audio_b64) // 4 * 3
+
+    async def send_loop(self, ws):
+        coalescer = AudioCoalescer(self.min_bytes, self.max_latency)
+        sent_position = self.session_start
+        while True:
+            timeout = max(self.max_latency - coalescer.age(), 0.01) if coalescer.first_time else self.stats_interval
+            try:
+                kind, position, payload = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await self.flush(ws, coalescer)
+                self.report()
+                continue
+
+            self.max_depth = max(self.max_depth, self.queue.qsize() + 1)
+            if kind == "audio":
+                coalescer.add(payload)
+                sent_position = position
+                if coalescer.ready():
+                    await self.flush(ws, coalescer)
+            elif kind == "event":
+                # Control events must follow all the audio queued before them
+                await self.flush(ws, coalescer)
+                await ws.send_str(json.dumps(payload))
+                if payload["type"] in RELEASE_EVENTS:
+                    self.release(sent_position)
+                elif payload["type"] == "response.create":
+                    self.pending_responses += 1
+                    self.requested_responses += 1
+                    self.idle.clear()
+            else:
+                await self.flush(ws, coalescer)
+                return
+            self.report()
+
+    async def receive_loop(self, ws):
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                event = json.loads(msg.data)
+                event_type = event.get("type")
+                if event_type == "response.created":
+                    # Responses started by server VAD have no response.create of ours
+                    if self.requested_responses:
+                        self.requested_responses -= 1
+                    else:
+                        self.pending_responses += 1
+                        self.idle.clear()
+                elif event_type == "response.done":
+                    self.pending_responses = max(self.pending_responses - 1, 0)
+                    if self.pending_responses == 0:
+                        self.idle.set()
+                elif event_type == "input_audio_buffer.speech_stopped" and "audio_end_ms" in event:
+                    # Server VAD consumed the audio up to here
+                    self.release(self.session_start + event["audio_end_ms"] * self.bytes_per_second // 1000)
+                try:
+                    self.on_event(event)
+                except Exception as e:
+                    print(f"{self.tag}Exception handling event {event_type}: {e}")
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                raise ws.exception()
+
+    async def serve(self, ws):
+        await ws.send_json({"type": "session.update", "session": self.session})
+        if self.disconnected_at is not None:
+            print(f"{self.tag}Reconnected after {time.time() - self.disconnected_at:.1f}s, replaying "
+                  f"{self.ring_size / self.bytes_per_second:.1f}s of audio, "
+                  f"{self.dropped_bytes / self.bytes_per_second:.1f}s lost")
+            self.disconnected_at = None
+            self.dropped_bytes = 0
+        self.start_replay()
+
+        sender = asyncio.create_task(self.send_loop(ws))
+        receiver = asyncio.create_task(self.receive_loop(ws))
+        try:
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if sender in done and sender.exception() is None:
+                # Input ended, give outstanding responses a chance to arrive
+                try:
+                    await asyncio.wait_for(self.idle.wait(), self.close_timeout)
+                except asyncio.TimeoutError:
+                    self.log(f"Closing with {self.pending_responses} responses outstanding")
+        finally:
+            self.connected = False
+            sender.cancel()
+            receiver.cancel()
+            await asyncio.gather(sender, receiver, return_exceptions=True)
+        for task in done:
+            task.result()
+
+    async def run(self, http=None):
+        # Clients given a shared ClientSession also share its connection pool
+        if http is None:
+            async with aiohttp.ClientSession() as http:
+                return await self.run(http)
+
+        self.idle = asyncio.Event()
+        backoff = 1.0
+        while not self.stopped:
+            connected_at = time.time()
+            try:
+                async with http.ws_connect(self.url, headers=self.headers, heartbeat=20) as ws:
+                    await self.serve(ws)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                print(f"{self.tag}WebSocket error: {e}")
+            if self.stopped:
+                break
+
+            if time.time() - connected_at > 60:
+                backoff = 1.0
+            if self.disconnected_at is None:
+                self.disconnected_at = time.time()
+            print(f"{self.tag}WebSocket connection closed, reconnecting in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
@@ -0,0 +1,77 @@
+import os
+import logging
+
+import numpy as np
+
+
+class SpeakerIndex:
+    # Enrolled speaker embeddings, one L2-normalized row per name, stored as a .npz
+    def __init__(self, model, names=None, embeddings=None, counts=None, threshold=0.6):
+        self.model = model
+        self.threshold = threshold
+        self.names = list(names) if names is not None else []
+        self.embeddings = embeddings if embeddings is not None else np.zeros((0, 0), dtype=np.float32)
+        self.counts = counts if counts is not None else np.zeros(0, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path, model=None):
+        if not os.path.exists(path):
+            return cls(model)
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(str(data["model"]), data["names"].tolist(), data["embeddings"].astype(np.float32),
+                        data["counts"].astype(np.float32))
+        if model is not None and index.model != model:
+            raise ValueError(f"Speaker index {path} was enrolled with {index.model}, not {model}")
+        return index
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, model=np.array(self.model), names=np.array(self.names),
+                 embeddings=self.embeddings, counts=self.counts)
+        os.replace(tmp_path, path)
+
+    def enroll(self, name, embedding: np.ndarray):
+        embedding = embedding.astype(np.float32) / (np.linalg.norm(embedding) + 1e-9)
+        if name in self.names:
+            # Further samples refine the running mean of the speaker
+            i = self.names.index(name)
+            mean = self.embeddings[i] * self.counts[i] + embedding
+            self.embeddings[i] = mean / (np.linalg.norm(mean) + 1e-9)
+            self.counts[i] += 1
+        elif len(self.names) == 0:
+            self.names = [name]
+            self.embeddings = embedding[np.newaxis, :]
+            self.counts = np.ones(1, dtype=np.float32)
+        else:
+            self.names.append(name)
+            self.embeddings = np.vstack([self.embeddings, embedding])
+            self.counts = np.append(self.counts, np.float32(1))
+
+    def remove(self, name):
+        i = self.names.index(name)
+        del self.names[i]
+        self.embeddings = np.delete(self.embeddings, i, axis=0)
+        self.counts = np.delete(self.counts, i)
+
+    def match(self, centroids: np.ndarray) -> list:
+        # All centroids against all enrolled speakers in one matrix product
+        if len(self.names) == 0 or len(centroids) == 0:
+            return [None] * len(centroids)
+        centroids = centroids / (np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-9)
+        similarity = centroids.astype(np.float32) @ self.embeddings.T
+        best = np.argmax(similarity, axis=1)
+        scores = similarity[np.arange(len(best)), best]
+        return [self.names[i] if score >= self.threshold else None for i, score in zip(best, scores)]
+
+
+def load_speaker_index(path, model, threshold):
+    if not path:
+        return None
+    try:
+        index = SpeakerIndex.load(path, model)
+    except ValueError as e:
+        logging.error(f"{e}, known speaker identification disabled")
+        return None
+    logging.info(f"Loaded {len(index.names)} known speakers from {path}")
+    index.threshold = threshold
+    return index
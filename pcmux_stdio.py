@@ -0,0 +1,67 @@
+import sys
+import json
+import asyncio
+import logging
+
+# Video frames are single lines of base64 PNG, well past the 64 KB StreamReader default
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+async def open_stdin(limit=LINE_LIMIT):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=limit)
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except ValueError:
+        # Regular files cannot be watched by the event loop
+        return None
+    return reader
+
+
+async def read_lines(limit=LINE_LIMIT):
+    # Raw lines from stdin until EOF, without a thread pool round trip per line
+    reader = await open_stdin(limit)
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if reader is None:
+                line = await loop.run_in_executor(None, sys.stdin.buffer.readline)
+            else:
+                line = await reader.readline()
+        except ValueError:
+            logging.warning(f"Skipping PCMux line longer than {limit} bytes")
+            continue
+        if not line:
+            break
+        yield line
+
+
+async def read_events(limit=LINE_LIMIT):
+    async for line in read_lines(limit):
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            logging.debug("Received non-JSON message.")
+
+
+class EventWriter:
+    # PCMux events on stdout without blocking the event loop when the reader is slow
+    def __init__(self):
+        self.writer = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        try:
+            transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+        except ValueError:
+            return
+        self.writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def write(self, event):
+        line = (json.dumps(event) + "\n").encode()
+        if self.writer is None:
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+            return
+        self.writer.write(line)
+        await self.writer.drain()
@@ -0,0 +1,118 @@
+import time
+import base64
+
+import numpy as np
+
+
+def append_message(audio_b64):
+    # Base64 never needs JSON escaping, so skip json.dumps on the large payload
+    return '{"type": "input_audio_buffer.append", "audio": "' + audio_b64 + '"}'
+
+
+class AudioCoalescer:
+    # Joins pcmux.audio.delta payloads into larger appends. Unpadded base64 is
+    # reused as-is; padded pieces are re-encoded on 3 byte boundaries so the
+    # concatenated string stays valid base64
+    def __init__(self, min_bytes=9600, max_latency=0.3):
+        self.min_bytes = min_bytes
+        self.max_latency = max_latency
+        self.parts = []
+        self.leftover = b""
+        self.pending_bytes = 0
+        self.first_time = None
+
+    def add(self, delta_b64):
+        if self.first_time is None:
+            self.first_time = time.time()
+        if not self.leftover and not delta_b64.endswith("="):
+            self.parts.append(delta_b64)
+            self.pending_bytes += len(delta_b64) // 4 * 3
+            return
+        decoded = base64.b64decode(delta_b64)
+        self.pending_bytes += len(decoded)
+        raw = self.leftover + decoded
+        usable = len(raw) - len(raw) % 3
+        if usable:
+            self.parts.append(base64.b64encode(raw[:usable]).decode("ascii"))
+        self.leftover = raw[usable:]
+
+    def age(self):
+        return time.time() - self.first_time if self.first_time is not None else 0.0
+
+    def ready(self):
+        return self.pending_bytes >= self.min_bytes or (self.first_time is not None and self.age() >= self.max_latency)
+
+    def flush(self):
+        if self.leftover:
+            self.parts.append(base64.b64encode(self.leftover).decode("ascii"))
+        audio_b64 = "".join(self.parts)
+        self.parts = []
+        self.leftover = b""
+        self.pending_bytes = 0
+        self.first_time = None
+        return audio_b64 or None
+
+
+
+UPLINK_FORMATS = ["pcm16", "g711_ulaw", "g711_alaw"]
+
+ULAW_SEGMENTS = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+ALAW_SEGMENTS = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+
+
+def ulaw_encode(samples: np.ndarray) -> np.ndarray:
+    # G.711 µ-law, same tables as the reference g711.c
+    pcm = samples.astype(np.int32) >> 2
+    mask = np.where(pcm < 0, 0x7F, 0xFF)
+    pcm = np.minimum(np.abs(pcm), 8159) + 0x21
+    segment = np.searchsorted(ULAW_SEGMENTS, pcm)
+    value = (segment << 4) | ((pcm >> (segment + 1)) & 0x0F)
+    value = np.where(segment >= 8, 0x7F, value)
+    return (value ^ mask).astype(np.uint8)
+
+
+def alaw_encode(samples: np.ndarray) -> np.ndarray:
+    # G.711 A-law, same tables as the reference g711.c
+    pcm = samples.astype(np.int32) >> 3
+    mask = np.where(pcm >= 0, 0xD5, 0x55)
+    pcm = np.where(pcm >= 0, pcm, -pcm - 1)
+    segment = np.searchsorted(ALAW_SEGMENTS, pcm)
+    value = (segment << 4) | ((pcm >> np.maximum(segment, 1)) & 0x0F)
+    return (value ^ mask).astype(np.uint8)
+
+
+class Decimator:
+    # Integer-factor downsampling with a windowed-sinc low-pass, keeping the filter
+    # history and output phase across chunks
+    def __init__(self, factor=3, taps=63):
+        n = np.arange(taps) - (taps - 1) / 2
+        cutoff = 0.45 / factor
+        kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+        self.kernel = (kernel / kernel.sum()).astype(np.float32)
+        self.factor = factor
+        self.history = np.zeros(taps - 1, dtype=np.float32)
+        self.phase = 0
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        x = np.concatenate([self.history, samples.astype(np.float32)])
+        filtered = np.convolve(x, self.kernel, mode="valid")
+        self.history = x[len(x) - len(self.history):]
+        out = filtered[self.phase::self.factor]
+        self.phase = (self.phase - len(samples)) % self.factor
+        return np.clip(np.round(out), -32768, 32767).astype(np.int16)
+
+
+class UplinkEncoder:
+    # Converts 24 kHz pcm16 deltas to an 8 kHz G.711 input_audio_format
+    def __init__(self, audio_format, sample_rate=24000):
+        self.compand = ulaw_encode if audio_format == "g711_ulaw" else alaw_encode
+        self.decimator = Decimator(sample_rate // 8000)
+
+    def encode(self, delta_b64):
+        samples = np.frombuffer(base64.b64decode(delta_b64), dtype=np.int16)
+        encoded = self.compand(self.decimator.process(samples))
+        return base64.b64encode(encoded.tobytes()).decode("ascii")
+
+
+def uplink_bytes_per_second(audio_format, sample_rate=24000):
+    return sample_rate * 2 if audio_format == "pcm16" else 8000
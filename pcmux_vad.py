@@ -0,0 +1,214 @@
+import logging
+from collections import deque
+
+import numpy as np
+
+COMMIT = "commit"
+SKIP = "skip"
+
+
+class EnergyVAD:
+    def __init__(self, sample_rate=24000, frame_duration=0.02, threshold_db=-45.0, margin_db=10.0, max_zcr=0.35):
+        self.sample_rate = sample_rate
+        self.frame_size = int(frame_duration * sample_rate)
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.max_zcr = max_zcr
+        self.noise_floor_db = threshold_db - margin_db
+
+    def speech_frames(self, samples: np.ndarray) -> np.ndarray:
+        # samples is int16 with a length that is a multiple of frame_size
+        frames = samples.reshape(-1, self.frame_size).astype(np.float32) / 32768.0
+        if len(frames) == 0:
+            return np.zeros(0, dtype=bool)
+
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+        level_db = 20.0 * np.log10(rms + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+
+        threshold = max(self.threshold_db, self.noise_floor_db + self.margin_db)
+        # Noisy high-ZCR frames only count when they are clearly above the threshold
+        speech = (level_db > threshold) & ((zcr < self.max_zcr) | (level_db > threshold + self.margin_db))
+
+        # Track the noise floor slowly from the quiet frames
+        if (~speech).any():
+            quiet = float(np.median(level_db[~speech]))
+            self.noise_floor_db += 0.05 * (quiet - self.noise_floor_db)
+        return speech
+
+
+class SileroVAD:
+    # Optional model-based VAD: https://github.com/snakers4/silero-vad
+    def __init__(self, sample_rate=24000, threshold=0.5):
+        import torch
+        self.torch = torch
+        self.model, _ = torch.hub.load("snakers4/silero-vad", "silero_vad", trust_repo=True)
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        # The model runs on 512 sample windows at 16 kHz
+        self.frame_size = int(512 * sample_rate / 16000)
+        self.positions = np.linspace(0, self.frame_size - 1, 512)
+
+    def speech_frames(self, samples: np.ndarray) -> np.ndarray:
+        frames = samples.reshape(-1, self.frame_size).astype(np.float32) / 32768.0
+        speech = np.zeros(len(frames), dtype=bool)
+        with self.torch.no_grad():
+            for i, frame in enumerate(frames):
+                if self.frame_size != 512:
+                    frame = np.interp(self.positions, np.arange(self.frame_size), frame).astype(np.float32)
+                prob = self.model(self.torch.from_numpy(frame), 16000).item()
+                speech[i] = prob > self.threshold
+        return speech
+
+
+def create_vad(kind, sample_rate):
+    if kind == "energy":
+        return EnergyVAD(sample_rate)
+    if kind == "silero":
+        return SileroVAD(sample_rate)
+    return None
+
+
+class VADSegmenter:
+    def __init__(self, vad, min_window=2.0, max_window=15.0, min_silence=0.5):
+        self.vad = vad
+        self.min_window = int(min_window * vad.sample_rate)
+        self.max_window = int(max_window * vad.sample_rate)
+        self.min_silence = int(min_silence * vad.sample_rate)
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.reset()
+
+    def reset(self):
+        self.buffered = 0
+        self.speech = 0
+        self.trailing_silence = 0
+
+    def push(self, samples: np.ndarray):
+        self.buffered += len(samples)
+        samples = np.concatenate([self.remainder, samples])
+        usable = len(samples) - len(samples) % self.vad.frame_size
+        self.remainder = samples[usable:]
+
+        speech = self.vad.speech_frames(samples[:usable])
+        if speech.any():
+            last = len(speech) - 1 - int(np.argmax(speech[::-1]))
+            self.speech += int(speech.sum()) * self.vad.frame_size
+            self.trailing_silence = (len(speech) - 1 - last) * self.vad.frame_size
+        else:
+            self.trailing_silence += usable
+
+    def poll(self):
+        # Decide what to do with the audio buffered since the last commit or skip
+        action = None
+        if self.speech == 0:
+            if self.trailing_silence >= self.min_silence:
+                action = SKIP
+        elif self.buffered >= self.max_window:
+            action = COMMIT
+        elif self.buffered >= self.min_window and self.trailing_silence >= self.min_silence:
+            action = COMMIT
+
+        if action is not None:
+            logging.debug(f"VAD {action}: {self.buffered / self.vad.sample_rate:.2f}s buffered, "
+                          f"{self.speech / self.vad.sample_rate:.2f}s speech")
+            self.reset()
+        return action
+
+    def flush(self):
+        action = COMMIT if self.speech > 0 else SKIP
+        self.reset()
+        self.remainder = np.zeros(0, dtype=np.int16)
+        return action
+
+
+class SilenceGate:
+    # Holds back silent deltas before they are uploaded, keeping pre_roll seconds
+    # ahead of each speech onset and hangover seconds after the last speech frame
+    def __init__(self, vad, hangover=0.8, pre_roll=0.3, report_interval=60.0):
+        self.vad = vad
+        self.hangover = int(hangover * vad.sample_rate)
+        self.pre_roll = int(pre_roll * vad.sample_rate)
+        self.report_interval = int(report_interval * vad.sample_rate)
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.held = deque()
+        self.held_samples = 0
+        self.since_speech = self.hangover
+        self.total = 0
+        self.suppressed = 0
+        self.next_report = self.report_interval
+
+    def process(self, delta, samples: np.ndarray) -> list:
+        # Returns the deltas to forward, oldest first
+        count = len(samples)
+        self.total += count
+        samples = np.concatenate([self.remainder, samples])
+        usable = len(samples) - len(samples) % self.vad.frame_size
+        self.remainder = samples[usable:]
+
+        speech = self.vad.speech_frames(samples[:usable])
+        is_open = speech.any() or self.since_speech < self.hangover
+        if speech.any():
+            last = len(speech) - 1 - int(np.argmax(speech[::-1]))
+            self.since_speech = (len(speech) - 1 - last) * self.vad.frame_size
+        else:
+            self.since_speech += usable
+
+        if is_open:
+            forward = [held for held, _ in self.held] + [delta]
+            self.held.clear()
+            self.held_samples = 0
+            return forward
+
+        self.held.append((delta, count))
+        self.held_samples += count
+        while self.held_samples - self.held[0][1] >= self.pre_roll:
+            _, dropped = self.held.popleft()
+            self.held_samples -= dropped
+            self.suppressed += dropped
+        return []
+
+    def stats(self):
+        rate = self.vad.sample_rate
+        share = 100.0 * self.suppressed / self.total if self.total else 0.0
+        return f"Silence gate suppressed {self.suppressed / rate:.1f}s of {self.total / rate:.1f}s ({share:.0f}%)"
+
+    def report(self):
+        if self.total < self.next_report:
+            return None
+        self.next_report = self.total + self.report_interval
+        return self.stats()
+
+
+def add_vad_arguments(parser):
+    parser.add_argument("--vad", choices=["energy", "silero", "none"], default="energy",
+                        help="Commit at speech pauses using this VAD, 'none' commits on a fixed interval (default: energy)")
+    parser.add_argument("--min-window", type=float, default=2.0,
+                        help="Minimum seconds of audio per VAD commit (default: 2.0)")
+    parser.add_argument("--max-window", type=float, default=15.0,
+                        help="Maximum seconds of audio per VAD commit (default: 15.0)")
+    parser.add_argument("--min-silence", type=float, default=0.5,
+                        help="Pause length in seconds that ends a VAD commit (default: 0.5)")
+
+
+def add_gate_arguments(parser):
+    parser.add_argument("--silence-gate", choices=["energy", "silero", "none"], default="none",
+                        help="Hold back silent audio instead of uploading it (default: none)")
+    parser.add_argument("--hangover", type=float, default=0.8,
+                        help="Seconds still uploaded after speech ends with --silence-gate (default: 0.8)")
+    parser.add_argument("--pre-roll", type=float, default=0.3,
+                        help="Seconds uploaded ahead of a speech onset with --silence-gate (default: 0.3)")
+
+
+def create_gate(args, sample_rate):
+    vad = create_vad(args.silence_gate, sample_rate)
+    if vad is None:
+        return None
+    return SilenceGate(vad, hangover=args.hangover, pre_roll=args.pre_roll)
+
+
+def create_segmenter(args, sample_rate):
+    vad = create_vad(args.vad, sample_rate)
+    if vad is None:
+        return None
+    return VADSegmenter(vad, min_window=args.min_window, max_window=args.max_window, min_silence=args.min_silence)
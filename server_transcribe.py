@@ -0,0 +1,174 @@
+import os
+import json
+import asyncio
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Loads the models once and keeps them warm for every connected pipeline
+from tee_transcribe_annote import AudioProcessor, Models, parse_model_ladder, setup_logging
+from pcmux_vad import add_vad_arguments, create_segmenter
+from pcmux_cache import ResultCache
+from pcmux_diarize import REUSE_OVERLAP, diarization_model_names
+from pcmux_speakers import load_speaker_index
+
+DEFAULT_SOCKET = os.getenv("PCMUX_TRANSCRIBE_SOCKET", "/tmp/pcmux_transcribe.sock")
+
+# Settings a client may override with a pcmux.session.update event
+SESSION_FIELDS = ("commit_interval", "sample_rate", "overlap", "speaker_threshold", "partial", "word_timestamps", "max_lag",
+                  "vad", "min_window", "max_window", "min_silence")
+
+# Video frames are forwarded by some clients, allow large lines
+LINE_LIMIT = 16 * 1024 * 1024
+
+# Output queued for a client that is not reading it, beyond which the session is closed
+WRITE_LIMIT = 4 * 1024 * 1024
+
+
+class TranscriptionServer:
+    def __init__(self, models, defaults, cache=None, speaker_index=None):
+        self.models = models
+        self.cache = cache
+        self.speaker_index = speaker_index
+        self.defaults = defaults
+        self.session_count = 0
+
+    def create_processor(self, settings, emit):
+        options = vars(self.defaults).copy()
+        options.update({key: value for key, value in settings.items() if key in SESSION_FIELDS})
+        args = argparse.Namespace(**options)
+        return AudioProcessor(commit_interval=args.commit_interval, verbose=args.verbose, sample_rate=args.sample_rate,
+                              overlap=args.overlap, speaker_threshold=args.speaker_threshold,
+                              segmenter=create_segmenter(args, args.sample_rate),
+                              models=self.models, emit=emit, partial_interval=args.partial,
+                              word_timestamps=args.word_timestamps, max_lag=args.max_lag, cache=self.cache,
+                              speaker_index=self.speaker_index)
+
+    async def handle_client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        self.session_count += 1
+        session_id = self.session_count
+        logging.info(f"Session {session_id} connected")
+
+        too_slow = False
+
+        def write(line):
+            nonlocal too_slow
+            if too_slow:
+                return
+            if writer.transport.get_write_buffer_size() > WRITE_LIMIT:
+                logging.warning(f"Session {session_id} is not reading its output, closing it")
+                too_slow = True
+                # Closing would wait to flush the backlog, drop it instead
+                writer.transport.abort()
+                return
+            writer.write(line)
+
+        def emit(event):
+            # Called from the session's worker thread
+            loop.call_soon_threadsafe(write, (json.dumps(event) + "\n").encode())
+
+        # One worker thread per session keeps its messages in order while
+        # other sessions run in parallel on the shared models
+        executor = ThreadPoolExecutor(max_workers=1)
+        settings = {}
+        processor = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line or too_slow:
+                    break
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.debug("Received non-JSON message.")
+                    continue
+
+                if message.get("type") == "pcmux.session.update":
+                    if processor is None:
+                        settings.update(message.get("session", {}))
+                        logging.info(f"Session {session_id} settings: {settings}")
+                    else:
+                        logging.warning(f"Session {session_id} ignoring session.update after audio started")
+                    continue
+
+                if processor is None:
+                    processor = await loop.run_in_executor(executor, self.create_processor, settings, emit)
+                await loop.run_in_executor(executor, processor.handle_message, message)
+
+            if too_slow:
+                return
+            if processor is not None:
+                await loop.run_in_executor(executor, processor.finish)
+            await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            logging.info(f"Session {session_id} connection lost")
+        except Exception as e:
+            logging.error(f"Session {session_id} error: {e}")
+        finally:
+            executor.shutdown(wait=False)
+            writer.close()
+            logging.info(f"Session {session_id} closed")
+
+
+async def serve(server, socket_path):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    unix_server = await asyncio.start_unix_server(server.handle_client, path=socket_path, limit=LINE_LIMIT)
+    logging.info(f"Transcription server listening on {socket_path}")
+    try:
+        async with unix_server:
+            await unix_server.serve_forever()
+    finally:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcription daemon keeping the whisper and pyannote models loaded for many pipelines.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("-s", "--socket", default=DEFAULT_SOCKET,
+                        help=f"Unix socket to listen on (default: {DEFAULT_SOCKET})")
+    parser.add_argument("-c", "--commit-interval", type=float, default=5.0,
+                        help="Default commit interval in seconds with --vad none (default: 5.0)")
+    parser.add_argument("--sample-rate", type=int, default=16000, help="Default sample rate for processing audio")
+    parser.add_argument("--overlap", type=float, default=REUSE_OVERLAP,
+                        help=f"Default seconds of the previous window re-diarized as context (default: {REUSE_OVERLAP})")
+    parser.add_argument("--speaker-threshold", type=float, default=0.5,
+                        help="Default cosine similarity needed to match a known speaker (default: 0.5)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of segments transcribed in parallel across all sessions (default: 1)")
+    parser.add_argument("--cpu-threads", type=int, default=0,
+                        help="CPU threads per transcription worker, 0 for the CTranslate2 default (default: 0)")
+    parser.add_argument("-p", "--partial", type=float, nargs="?", const=1.0, default=None, metavar="SECONDS",
+                        help="Default to streaming pcmux.text.partial events, re-decoding every SECONDS (default: off)")
+    parser.add_argument("--word-timestamps", action="store_true",
+                        help="Default to per-word start/end offsets in pcmux.text.chunk events")
+    parser.add_argument("-m", "--models", type=parse_model_ladder, default=None,
+                        help="Whisper models to step down through when a session falls behind, largest first, "
+                             "e.g. medium.en:5,small.en,base.en (default: WHISPER_MODEL_PATH or medium.en)")
+    parser.add_argument("--max-lag", type=float, default=5.0,
+                        help="Default seconds behind real time before switching to a smaller model (default: 5.0)")
+    parser.add_argument("--cache-dir", help="Cache diarization and transcription results for repeated audio in this directory")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Maximum cache size in MB (default: 1024)")
+    parser.add_argument("--speakers", help="Speaker index from enroll_speaker.py, matching speakers are reported by name")
+    parser.add_argument("--known-threshold", type=float, default=0.6,
+                        help="Cosine similarity needed to name a speaker from the index (default: 0.6)")
+    add_vad_arguments(parser)
+    args = parser.parse_args()
+
+    setup_logging(logging.DEBUG if args.verbose else logging.INFO)
+    logging.info("Loading models...")
+    models = Models(workers=args.workers, cpu_threads=args.cpu_threads, ladder=args.models)
+
+    cache = ResultCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+    speaker_index = load_speaker_index(args.speakers, diarization_model_names()[1], args.known_threshold)
+    server = TranscriptionServer(models, args, cache, speaker_index)
+    try:
+        asyncio.run(serve(server, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,22 @@
 import os
 import json
-import threading
-import websocket
+import asyncio
 import sys
 import signal
 import time
 from dotenv import load_dotenv
 import argparse
+import aiohttp
 import base64
+import numpy as np
+from pcmux_realtime import RealtimeClient
+from pcmux_stdio import read_events
+from pcmux_uplink import UPLINK_FORMATS
+from pcmux_vad import add_gate_arguments, create_gate
 
 load_dotenv()
 
-WEBSOCKET_URL = "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01"
+WEBSOCKET_URL = os.getenv("OPENAI_REALTIME_URL", "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01")
 
 interrupted = False
 
@@ -23,106 +28,174 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
-class AudioReceiver:
-    def __init__(self, ws):
-        self.ws = ws
-        self.thread = threading.Thread(target=self.receive_audio, daemon=True)
-        self.running = False
-
-    def start(self):
-        self.running = True
-        self.thread.start()
-
-    def receive_audio(self):
-        try:
-            for line in sys.stdin:
-                if not self.running:
-                    break
-                message = json.loads(line)
-                if message.get("type") == "pcmux.audio.delta":
-                    audio_event = {"type": "input_audio_buffer.append", "audio": message["delta"]}
-                    self.ws.send(json.dumps(audio_event))
-        except KeyboardInterrupt:
-            pass
-
-    def stop(self):
-        self.running = False
+INSTRUCTIONS = "You will be listening to a conversation. Your job is to notice when you can be helpful. You are not part of the conversation, you are only an observer, and you don't need to transcribe, just focus on providing concise actionable suggestions."
+
+def forward_audio(client, gate, delta, log):
+    if gate is None:
+        client.append_audio(delta)
+        return
+    samples = np.frombuffer(base64.b64decode(delta), dtype=np.int16)
+    for gated in gate.process(delta, samples):
+        client.append_audio(gated)
+    summary = gate.report()
+    if summary:
+        log(summary)
+
+async def receive_audio(client, gate=None, log=print):
+    async for message in read_events():
+        if message.get("type") == "pcmux.audio.delta":
+            forward_audio(client, gate, message["delta"], log)
+    client.stop()
+    if gate:
+        print(gate.stats())
+
+class ObservedStream:
+    def __init__(self, client, gate, task):
+        self.client = client
+        self.gate = gate
+        self.task = task
+        self.last_audio = time.time()
+
+class StreamPool:
+    # One Realtime session per stream id of a multiplexed input, all on one event loop
+    # and one HTTP connection pool
+    def __init__(self, chat, max_streams=50, idle_timeout=300.0):
+        self.chat = chat
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.streams = {}
+        self.ignored = set()
+        self.closing = set()
+        self.http = None
+
+    def open(self, stream):
+        if len(self.streams) >= self.max_streams:
+            if stream not in self.ignored:
+                print(f"Ignoring stream {stream}, already observing {self.max_streams}")
+                self.ignored.add(stream)
+            return None
+        tag = f"[{stream}] "
+        client = self.chat.create_client(tag)
+        gate = create_gate(self.chat.gate_args, 24000) if self.chat.gate_args else None
+        observed = ObservedStream(client, gate, asyncio.create_task(client.run(self.http)))
+        self.streams[stream] = observed
+        self.chat.log(f"Opened session for stream {stream}, {len(self.streams)} active")
+        return observed
+
+    def close(self, stream):
+        observed = self.streams.pop(stream)
+        observed.client.stop()
+        if observed.gate:
+            print(f"[{stream}] {observed.gate.stats()}")
+        return observed.task
+
+    async def close_idle(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 10.0))
+            now = time.time()
+            for stream, observed in list(self.streams.items()):
+                if now - observed.last_audio > self.idle_timeout:
+                    self.chat.log(f"Stream {stream} idle for {self.idle_timeout:.0f}s, closing its session")
+                    task = self.close(stream)
+                    self.closing.add(task)
+                    task.add_done_callback(self.closing.discard)
+
+    async def run(self):
+        async with aiohttp.ClientSession() as http:
+            self.http = http
+            reaper = asyncio.create_task(self.close_idle())
+            async for message in read_events():
+                if message.get("type") != "pcmux.audio.delta":
+                    continue
+                stream = str(message.get("stream", ""))
+                observed = self.streams.get(stream) or self.open(stream)
+                if observed is None:
+                    continue
+                observed.last_audio = time.time()
+                forward_audio(observed.client, observed.gate, message["delta"], self.chat.log)
+            reaper.cancel()
+            tasks = [self.close(stream) for stream in list(self.streams)]
+            await asyncio.gather(*tasks, *self.closing, return_exceptions=True)
 
 class ChatStreaming:
-    def __init__(self, api_key, verbose=False):
+    def __init__(self, api_key, url=WEBSOCKET_URL, verbose=False, append_ms=200, max_latency=0.3, replay_seconds=10.0,
+                 uplink_format="pcm16", gate_args=None, max_streams=50, idle_timeout=300.0):
         self.api_key = api_key
-        self.ws = None
+        self.url = url
+        self.gate_args = gate_args
+        self.append_ms = append_ms
+        self.max_latency = max_latency
+        self.replay_seconds = replay_seconds
+        self.uplink_format = uplink_format
         self.verbose = verbose
-        self.audio_receiver = None
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
 
     def log(self, message):
         if self.verbose:
             print(f"[DEBUG] {message}")
 
-    def on_open(self, ws):
-        self.audio_receiver = AudioReceiver(ws)
-        self.audio_receiver.start()
-        session_update_message = {
-            "type": "session.update",
-            "session": {
-                "modalities": ["text"],
-                "instructions": "You will be listening to a conversation. Your job is to notice when you can be helpful. You are not part of the conversation, you are only an observer, and you don't need to transcribe, just focus on providing concise actionable suggestions.",
-                "turn_detection": {"type": "server_vad", "threshold": 0.5},
-                "temperature": 0.7,
-                "max_response_output_tokens": 500
-            }
+    def on_event(self, event, tag=""):
+        event_type = event.get("type")
+        if event_type == "response.done":
+            output = event.get("response", {}).get("output", [])
+            if output:
+                content = output[0].get("content", [])
+                if content:
+                    response_text = content[0].get("text", "")
+                    print(f"{tag}Comment: {response_text}")
+        elif event_type == "session.created":
+            print(f"{tag}Session started.")
+        elif event_type == "error":
+            print(f"{tag}Error: {event.get('error', {}).get('message')}")
+        elif event_type.startswith("input_audio_buffer.") or event_type.startswith("conversation.") or event_type.startswith("response.") or event_type == "session.updated" or event_type == "rate_limits.updated":
+            None
+        else:
+            self.log(f"{tag}Unhandled event type: {event_type} {json.dumps(event)}")
+
+    def create_client(self, tag=""):
+        session = {
+            "modalities": ["text"],
+            "instructions": INSTRUCTIONS,
+            "turn_detection": {"type": "server_vad", "threshold": 0.5},
+            "temperature": 0.7,
+            "max_response_output_tokens": 500
         }
-        ws.send(json.dumps(session_update_message))
-
-    def on_message(self, ws, message):
-        try:
-            event = json.loads(message)
-            event_type = event.get("type")
-            if event_type == "response.done":
-                output = event.get("response", {}).get("output", [])
-                if output:
-                    content = output[0].get("content", [])
-                    if content:
-                        response_text = content[0].get("text", "")
-                        print(f"Comment: {response_text}")
-            elif event_type == "session.created":
-                print("Session started.")
-            elif event_type == "error":
-                print(f"Error: {event.get('error', {}).get('message')}")
-            elif event_type.startswith("input_audio_buffer.") or event_type.startswith("conversation.") or event_type.startswith("response.") or event_type == "session.updated" or event_type == "rate_limits.updated":
-                None
-            else:
-                self.log(f"Unhandled event type: {event_type} {json.dumps(event)}")
-        except json.JSONDecodeError:
-            print("Received non-JSON message.")
-        except Exception as e:
-            print(f"Exception in on_message: {e} for event {json.dumps(event)}")
-
-    def on_error(self, ws, error):
-        print(f"WebSocket error: {error}")
-        self.log(f"WebSocket error: {error}")
-
-    def on_close(self, ws, close_status_code, close_msg):
-        print("WebSocket connection closed.")
-        self.log(f"WebSocket closed with code {close_status_code}, message: {close_msg}")
-        if self.audio_receiver:
-            self.audio_receiver.stop()
-
-    def run(self):
-        headers = {"Authorization": f"Bearer {self.api_key}", "OpenAI-Beta": "realtime=v1"}
-        self.ws = websocket.WebSocketApp(
-            WEBSOCKET_URL,
-            header=headers,
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close
-        )
-        self.ws.run_forever()
+        return RealtimeClient(self.url, self.api_key, session, lambda event: self.on_event(event, tag), self.log,
+                              replay_seconds=self.replay_seconds, append_ms=self.append_ms,
+                              max_latency=self.max_latency, audio_format=self.uplink_format, tag=tag)
+
+    async def run_async(self):
+        client = self.create_client()
+        gate = create_gate(self.gate_args, 24000) if self.gate_args else None
+        await asyncio.gather(client.run(), receive_audio(client, gate, self.log))
+
+    def run(self, multiplex=False):
+        if multiplex:
+            asyncio.run(StreamPool(self, self.max_streams, self.idle_timeout).run())
+        else:
+            asyncio.run(self.run_async())
 
 def main():
     parser = argparse.ArgumentParser(description="OpenAI Chat Passive Observer with PCMUX Audio Streaming")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("--url", default=WEBSOCKET_URL,
+                        help="Realtime API websocket endpoint (default: $OPENAI_REALTIME_URL or the OpenAI endpoint)")
+    parser.add_argument("--append-ms", type=int, default=200,
+                        help="Coalesce audio into appends of this many milliseconds (default: 200)")
+    parser.add_argument("--max-latency", type=float, default=0.3,
+                        help="Maximum seconds audio waits for coalescing before it is sent (default: 0.3)")
+    parser.add_argument("--uplink-format", choices=UPLINK_FORMATS, default="pcm16",
+                        help="Audio encoding sent to the Realtime API, g711 formats are 8 kHz at a sixth of the size (default: pcm16)")
+    parser.add_argument("--replay-seconds", type=float, default=10.0,
+                        help="Seconds of recent audio replayed after a reconnect (default: 10.0)")
+    parser.add_argument("-m", "--multiplex", action="store_true",
+                        help="Observe every stream of a multiplexed input, one session per \"stream\" field")
+    parser.add_argument("--max-streams", type=int, default=50,
+                        help="Most concurrent sessions with --multiplex (default: 50)")
+    parser.add_argument("--idle-timeout", type=float, default=300.0,
+                        help="Seconds without audio before a stream's session is closed with --multiplex (default: 300)")
+    add_gate_arguments(parser)
     args = parser.parse_args()
 
     api_key = os.getenv("OPENAI_API_KEY")
@@ -130,8 +203,11 @@ def main():
         print("Error: OPENAI_API_KEY environment variable not set.")
         sys.exit(1)
 
-    chat = ChatStreaming(api_key, verbose=args.verbose)
-    chat.run()
+    chat = ChatStreaming(api_key, url=args.url, verbose=args.verbose, append_ms=args.append_ms,
+                         max_latency=args.max_latency, replay_seconds=args.replay_seconds,
+                         uplink_format=args.uplink_format, gate_args=args, max_streams=args.max_streams,
+                         idle_timeout=args.idle_timeout)
+    chat.run(args.multiplex)
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,6 @@
 import os
 import json
-import threading
-import websocket
+import asyncio
 import sys
 import signal
 import time
@@ -11,10 +10,17 @@ import base64
 import google.generativeai as genai
 from io import BytesIO
 import wave
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pcmux_vad import COMMIT, SKIP, add_vad_arguments, add_gate_arguments, create_segmenter, create_gate
+from pcmux_realtime import RealtimeClient
+from pcmux_stdio import read_events
+from pcmux_uplink import UPLINK_FORMATS
 
 load_dotenv()
 
-WEBSOCKET_URL = "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01"
+WEBSOCKET_URL = os.getenv("OPENAI_REALTIME_URL", "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01")
 
 INSTRUCTIONS = "Your task is to provide clear and accurate transcriptions of everything you hear in the audio. Focus on producing verbatim transcripts, including all spoken words and meaningful sounds. No other added commentary, just the transcript please."
 
@@ -28,14 +34,96 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
+class GeminiWorker:
+    # Transcribes finished WAV buffers on a small thread pool, printing results in commit order.
+    # Only segments that have not started can be dropped, a running request cannot be stopped
+    def __init__(self, workers=2, max_pending=4, timeout=30.0):
+        self.model = genai.GenerativeModel('gemini-1.5-flash-8b')
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = deque()
+        self.waiting = deque()
+        self.running = 0
+        self.dropped = 0
+
+    def transcribe(self, audio_bytes):
+        response = self.model.generate_content([
+            INSTRUCTIONS,
+            {
+                "mime_type": "audio/wav",
+                "data": audio_bytes
+            }
+        ], request_options={"timeout": self.timeout})
+        return response.text
+
+    def submit(self, audio_bytes):
+        slot = asyncio.get_running_loop().create_future()
+        self.pending.append(slot)
+        self.waiting.append((slot, audio_bytes))
+        if len(self.waiting) > self.max_pending:
+            # Backed up, the oldest segment is the least useful one to wait for
+            self.waiting.popleft()[0].cancel()
+            self.dropped += 1
+            print(f"Gemini backed up, dropped a segment ({self.dropped} so far)")
+        self.start_waiting()
+        self.emit_ready()
+
+    def start_waiting(self):
+        loop = asyncio.get_running_loop()
+        while self.running < self.workers and self.waiting:
+            slot, audio_bytes = self.waiting.popleft()
+            self.running += 1
+            request = loop.run_in_executor(self.pool, self.transcribe, audio_bytes)
+            request.add_done_callback(lambda request, slot=slot: self.finished(request, slot))
+            loop.call_later(self.timeout, self.expire, slot)
+
+    def finished(self, request, slot):
+        # Counted as running until the thread returns, even after the slot timed out
+        self.running -= 1
+        if not slot.done():
+            if request.exception():
+                slot.set_exception(request.exception())
+            else:
+                slot.set_result(request.result())
+        self.start_waiting()
+        self.emit_ready()
+
+    def expire(self, slot):
+        if not slot.done():
+            slot.set_exception(asyncio.TimeoutError())
+            self.emit_ready()
+
+    def emit_ready(self):
+        while self.pending and self.pending[0].done():
+            future = self.pending.popleft()
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if isinstance(error, asyncio.TimeoutError):
+                print(f"Gemini API error: no response after {self.timeout:.0f}s")
+            elif error:
+                print(f"Gemini API error: {error}")
+            else:
+                print(f"gemini: {future.result()}")
+
+    async def drain(self):
+        await asyncio.gather(*self.pending, return_exceptions=True)
+        self.emit_ready()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
 class AudioReceiver:
-    def __init__(self, ws, commit_interval=5, use_gemini=False):
-        self.ws = ws
-        self.thread = threading.Thread(target=self.receive_audio, daemon=True)
-        self.running = False
+    def __init__(self, client, commit_interval=5, gemini=None, segmenter=None, gate=None, log=print):
+        self.client = client
+        self.segmenter = segmenter
+        self.gate = gate
+        self.log = log
+        self.appended = False
         self.commit_interval = commit_interval
         self.last_commit_time = time.time()
-        self.use_gemini = use_gemini
+        self.gemini = gemini
+        self.use_gemini = gemini is not None
         self.audio_buffer = BytesIO()
         self.wav_writer = None
 
@@ -44,149 +132,168 @@ class AudioReceiver:
         self.wav_writer = wave.open(self.audio_buffer, 'wb')
         self.wav_writer.setnchannels(1)
         self.wav_writer.setsampwidth(2)
-        self.wav_writer.setframerate(44100)
+        self.wav_writer.setframerate(24000)
 
     def process_with_gemini(self):
         if not self.wav_writer:
             return
-        
+
         self.wav_writer.close()
         audio_bytes = self.audio_buffer.getvalue()
-        
-        try:
-            model = genai.GenerativeModel('gemini-1.5-flash-8b')
-            response = model.generate_content([
-                INSTRUCTIONS,
-                {
-                    "mime_type": "audio/wav",
-                    "data": audio_bytes
-                }
-            ])
-            print(f"gemini: {response.text}")
-        except Exception as e:
-            print(f"Gemini API error: {e}")
-        
         self.initialize_wav()
+        self.gemini.submit(audio_bytes)
 
-    def start(self):
-        self.running = True
-        self.thread.start()
-
-    def receive_audio(self):
+    async def receive_audio(self):
         if self.use_gemini:
             self.initialize_wav()
-            
-        try:
-            for line in sys.stdin:
-                if not self.running:
-                    break
-                message = json.loads(line)
-                if message.get("type") == "pcmux.audio.delta":
-                    audio_event = {"type": "input_audio_buffer.append", "audio": message["delta"]}
-                    self.ws.send(json.dumps(audio_event))
 
+        async for message in read_events():
+            if message.get("type") == "pcmux.audio.delta":
+                if self.use_gemini or self.segmenter or self.gate:
+                    audio_data = base64.b64decode(message["delta"])
+
+                forward = [message["delta"]]
+                if self.gate:
+                    forward = self.gate.process(message["delta"], np.frombuffer(audio_data, dtype=np.int16))
+                    summary = self.gate.report()
+                    if summary:
+                        self.log(summary)
+                for delta in forward:
+                    self.client.append_audio(delta)
+                    self.appended = True
                     if self.use_gemini:
-                        audio_data = base64.b64decode(message["delta"])
-                        self.wav_writer.writeframes(audio_data)
-
-                    current_time = time.time()
-                    if current_time - self.last_commit_time >= self.commit_interval:
-                        self.ws.send(json.dumps({"type": "input_audio_buffer.commit"}))
-                        self.ws.send(json.dumps({"type": "response.create"}))
-                        if self.use_gemini:
-                            self.process_with_gemini()
-                        self.last_commit_time = current_time
-        except KeyboardInterrupt:
-            pass
-
-    def stop(self):
-        self.running = False
+                        self.wav_writer.writeframes(audio_data if delta is message["delta"] else base64.b64decode(delta))
+
+                if self.segmenter:
+                    self.segmenter.push(np.frombuffer(audio_data, dtype=np.int16))
+                    action = self.segmenter.poll()
+                    if action == COMMIT:
+                        self.commit()
+                    elif action == SKIP:
+                        self.skip()
+                    continue
+
+                current_time = time.time()
+                if current_time - self.last_commit_time >= self.commit_interval:
+                    self.commit()
+                    self.last_commit_time = current_time
+        self.client.stop()
+        if self.gate:
+            print(self.gate.stats())
+        if self.wav_writer:
+            # Audio after the last commit is not transcribed
+            self.wav_writer.close()
+            self.wav_writer = None
+        if self.gemini:
+            await self.gemini.drain()
+
+    def commit(self):
+        if not self.appended:
+            # Everything since the last commit was held back as silence
+            return
+        self.appended = False
+        self.client.send_event({"type": "input_audio_buffer.commit"})
+        self.client.send_event({"type": "response.create"})
+        if self.use_gemini:
+            self.process_with_gemini()
+
+    def skip(self):
+        # Silence only, drop it instead of paying for a response
+        if self.appended:
+            self.client.send_event({"type": "input_audio_buffer.clear"})
+        self.appended = False
+        if self.use_gemini:
+            self.wav_writer.close()
+            self.initialize_wav()
 
 class ChatStreaming:
-    def __init__(self, api_key, verbose=False, commit_interval=5, use_gemini=False):
+    def __init__(self, api_key, url=WEBSOCKET_URL, verbose=False, commit_interval=5, use_gemini=False, vad_args=None,
+                 append_ms=200, max_latency=0.3, replay_seconds=10.0, uplink_format="pcm16", gemini_workers=2,
+                 gemini_queue=4, gemini_timeout=30.0):
         self.api_key = api_key
-        self.ws = None
+        self.url = url
         self.verbose = verbose
         self.audio_receiver = None
         self.commit_interval = commit_interval
         self.use_gemini = use_gemini
+        self.vad_args = vad_args
+        self.append_ms = append_ms
+        self.max_latency = max_latency
+        self.replay_seconds = replay_seconds
+        self.uplink_format = uplink_format
+        self.gemini_workers = gemini_workers
+        self.gemini_queue = gemini_queue
+        self.gemini_timeout = gemini_timeout
 
     def log(self, message):
         if self.verbose:
             print(f"[DEBUG] {message}")
 
-    def on_open(self, ws):
-        self.audio_receiver = AudioReceiver(ws, self.commit_interval, self.use_gemini)
-        self.audio_receiver.start()
-        session_update_message = {
-            "type": "session.update",
-            "session": {
-                "modalities": ["text"],
-                "instructions": INSTRUCTIONS,
-                "temperature": 0.7,
-                "input_audio_transcription": {
-                    "model": "whisper-1"
-                },
-                "max_response_output_tokens": 500
-            }
+    def on_event(self, event):
+        event_type = event.get("type")
+        if event_type == "response.done":
+            output = event.get("response", {}).get("output", [])
+            if output:
+                content = output[0].get("content", [])
+                if content:
+                    response_text = content[0].get("text", "")
+                    print(f"gpt4o: {response_text}")
+        elif event_type == "session.created":
+            print("Session started.")
+        elif event_type == "conversation.item.input_audio_transcription.completed":
+            transcript = event.get("transcript", "")
+            print(f"whisper: {transcript}")
+        elif event_type == "error":
+            print(f"Error: {event.get('error', {}).get('message')}")
+        elif event_type.startswith("input_audio_buffer.") or event_type.startswith("conversation.") or event_type.startswith("response.") or event_type == "session.updated" or event_type == "rate_limits.updated":
+            None
+        else:
+            self.log(f"Unhandled event type: {event_type} {json.dumps(event)}")
+
+    async def run_async(self):
+        session = {
+            "modalities": ["text"],
+            "instructions": INSTRUCTIONS,
+            "temperature": 0.7,
+            "input_audio_transcription": {
+                "model": "whisper-1"
+            },
+            "max_response_output_tokens": 500
         }
-        ws.send(json.dumps(session_update_message))
-
-    def on_message(self, ws, message):
-        try:
-            event = json.loads(message)
-            event_type = event.get("type")
-            if event_type == "response.done":
-                output = event.get("response", {}).get("output", [])
-                if output:
-                    content = output[0].get("content", [])
-                    if content:
-                        response_text = content[0].get("text", "")
-                        print(f"gpt4o: {response_text}")
-            elif event_type == "session.created":
-                print("Session started.")
-            elif event_type == "conversation.item.input_audio_transcription.completed":
-                transcript = event.get("transcript", "")
-                print(f"whisper: {transcript}")
-            elif event_type == "error":
-                print(f"Error: {event.get('error', {}).get('message')}")
-            elif event_type.startswith("input_audio_buffer.") or event_type.startswith("conversation.") or event_type.startswith("response.") or event_type == "session.updated" or event_type == "rate_limits.updated":
-                None
-            else:
-                self.log(f"Unhandled event type: {event_type} {json.dumps(event)}")
-        except json.JSONDecodeError:
-            print("Received non-JSON message.")
-        except Exception as e:
-            print(f"Exception in on_message: {e} for event {json.dumps(event)}")
-
-    def on_error(self, ws, error):
-        print(f"WebSocket error: {error}")
-        self.log(f"WebSocket error: {error}")
-
-    def on_close(self, ws, close_status_code, close_msg):
-        print("WebSocket connection closed.")
-        self.log(f"WebSocket closed with code {close_status_code}, message: {close_msg}")
-        if self.audio_receiver:
-            self.audio_receiver.stop()
+        client = RealtimeClient(self.url, self.api_key, session, self.on_event, self.log,
+                                replay_seconds=self.replay_seconds, append_ms=self.append_ms,
+                                max_latency=self.max_latency, audio_format=self.uplink_format)
+        segmenter = create_segmenter(self.vad_args, 24000) if self.vad_args else None
+        gemini = GeminiWorker(self.gemini_workers, self.gemini_queue, self.gemini_timeout) if self.use_gemini else None
+        gate = create_gate(self.vad_args, 24000) if self.vad_args else None
+        self.audio_receiver = AudioReceiver(client, self.commit_interval, gemini, segmenter, gate, self.log)
+        await asyncio.gather(client.run(), self.audio_receiver.receive_audio())
 
     def run(self):
-        headers = {"Authorization": f"Bearer {self.api_key}", "OpenAI-Beta": "realtime=v1"}
-        self.ws = websocket.WebSocketApp(
-            WEBSOCKET_URL,
-            header=headers,
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close
-        )
-        self.ws.run_forever()
+        asyncio.run(self.run_async())
 
 def main():
     parser = argparse.ArgumentParser(description="Live transcriptions via streaming audio to OpenAI's GPT-4o model, whisper, and Gemini")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
     parser.add_argument("-c", "--commit-interval", type=float, default=5.0, 
-                      help="How often to commit audio buffer in seconds (default: 5.0)")
+                      help="How often to commit audio buffer in seconds with --vad none (default: 5.0)")
     parser.add_argument("-g", "--gemini", action="store_true", help="Enable Gemini API for audio processing")
+    parser.add_argument("--gemini-workers", type=int, default=2, help="Concurrent Gemini requests (default: 2)")
+    parser.add_argument("--gemini-queue", type=int, default=4,
+                      help="Gemini segments in flight before the oldest is dropped (default: 4)")
+    parser.add_argument("--gemini-timeout", type=float, default=30.0, help="Seconds to wait for a Gemini response (default: 30.0)")
+    parser.add_argument("--url", default=WEBSOCKET_URL,
+                      help="Realtime API websocket endpoint (default: $OPENAI_REALTIME_URL or the OpenAI endpoint)")
+    parser.add_argument("--append-ms", type=int, default=200,
+                      help="Coalesce audio into appends of this many milliseconds (default: 200)")
+    parser.add_argument("--max-latency", type=float, default=0.3,
+                      help="Maximum seconds audio waits for coalescing before it is sent (default: 0.3)")
+    parser.add_argument("--uplink-format", choices=UPLINK_FORMATS, default="pcm16",
+                      help="Audio encoding sent to the Realtime API, g711 formats are 8 kHz at a sixth of the size (default: pcm16)")
+    parser.add_argument("--replay-seconds", type=float, default=10.0,
+                      help="Seconds of uncommitted audio kept for replay after a reconnect (default: 10.0)")
+    add_vad_arguments(parser)
+    add_gate_arguments(parser)
     args = parser.parse_args()
 
     api_key = os.getenv("OPENAI_API_KEY")
@@ -201,8 +308,11 @@ def main():
             sys.exit(1)
         genai.configure(api_key=gemini_key)
 
-    chat = ChatStreaming(api_key, verbose=args.verbose, commit_interval=args.commit_interval, 
-                        use_gemini=args.gemini)
+    chat = ChatStreaming(api_key, url=args.url, verbose=args.verbose, commit_interval=args.commit_interval, 
+                        use_gemini=args.gemini, vad_args=args, append_ms=args.append_ms,
+                        max_latency=args.max_latency, replay_seconds=args.replay_seconds,
+                        uplink_format=args.uplink_format, gemini_workers=args.gemini_workers,
+                        gemini_queue=args.gemini_queue, gemini_timeout=args.gemini_timeout)
     chat.run()
 
 if __name__ == "__main__":
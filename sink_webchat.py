@@ -2,14 +2,20 @@ import os
 import sys
 import json
 import asyncio
+import base64
+import argparse
 import aiohttp
+import numpy as np
 from aiohttp import web
 from dotenv import load_dotenv
 import datetime
+from pcmux_vad import add_gate_arguments, create_gate
+from pcmux_uplink import UPLINK_FORMATS, UplinkEncoder
+from pcmux_stdio import read_events
 
 load_dotenv()
 
-WEBSOCKET_URL = "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01"
+WEBSOCKET_URL = os.getenv("OPENAI_REALTIME_URL", "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01")
 
 def timestamp():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
@@ -24,6 +30,53 @@ class OpenAIWSManager:
     def set_ws(self, ws):
         self.ws = ws
 
+class WebClient:
+    # Browser connection with its own bounded send queue, so a slow tab only delays itself
+    def __init__(self, ws, max_queue=256):
+        self.ws = ws
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.writer = asyncio.create_task(self.write_events())
+
+    def send(self, event):
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def write_events(self):
+        try:
+            while True:
+                event = await self.queue.get()
+                await self.ws.send_json(event)
+        except ConnectionResetError:
+            pass
+
+    async def close(self):
+        self.writer.cancel()
+        await self.ws.close()
+
+def broadcast(app, event):
+    for client in list(app['websockets']):
+        if not client.send(event):
+            print(f"[{timestamp()}] Client fell {client.queue.maxsize} events behind, disconnecting")
+            app['websockets'].discard(client)
+            asyncio.create_task(client.close())
+
+async def report_appended(app):
+    # One summary per second instead of an event per audio delta
+    while True:
+        await asyncio.sleep(1.0)
+        appended = app['appended']
+        if appended['count']:
+            broadcast(app, {
+                "type": "input_audio_buffer.appended",
+                "length": appended['length'],
+                "count": appended['count']
+            })
+            appended['length'] = 0
+            appended['count'] = 0
+
 async def handle_index(request):
     return web.FileResponse('./sink_webchat.html')
 
@@ -31,7 +84,8 @@ async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
     print(f"[{timestamp()}] New client WebSocket connection established")
-    request.app['websockets'].add(ws)
+    client = WebClient(ws, request.app['client_queue'])
+    request.app['websockets'].add(client)
     try:
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
@@ -41,7 +95,8 @@ async def websocket_handler(request):
                     await openai_ws.send_json(data)
                     print(f"[{timestamp()}] Message forwarded to OpenAI: {data['type']}")
     finally:
-        request.app['websockets'].discard(ws)
+        request.app['websockets'].discard(client)
+        client.writer.cancel()
         print(f"[{timestamp()}] Client WebSocket connection closed")
     return ws
 
@@ -54,7 +109,7 @@ async def openai_handler(app):
     ws_manager = app['ws_manager']
     
     async with aiohttp.ClientSession() as session:
-        async with session.ws_connect(WEBSOCKET_URL, headers=headers) as ws_openai:
+        async with session.ws_connect(app['url'], headers=headers) as ws_openai:
             ws_manager.set_ws(ws_openai)
             session_update_message = {
                 "type": "session.update",
@@ -66,6 +121,7 @@ async def openai_handler(app):
                         "model": "whisper-1"
                     },
                     "turn_detection": None,
+                    "input_audio_format": app['uplink_format'],
                     "max_response_output_tokens": 500
                 }
             }
@@ -73,24 +129,30 @@ async def openai_handler(app):
 
             async def read_stdin():
                 print(f"[{timestamp()}] Starting stdin reader")
-                loop = asyncio.get_running_loop()
-                while True:
-                    line = await loop.run_in_executor(None, sys.stdin.readline)
-                    if not line:
-                        break
-                    message = json.loads(line)
+                gate = app['gate']
+                encoder = UplinkEncoder(app['uplink_format']) if app['uplink_format'] != "pcm16" else None
+                async for message in read_events():
                     if message.get("type") == "pcmux.audio.delta":
-                        audio_event = {
-                            "type": "input_audio_buffer.append",
-                            "audio": message["delta"]
-                        }
-                        await ws_openai.send_json(audio_event)
-                        # Relay summary audio events to web clients
-                        for client_ws in app['websockets']:
-                            await client_ws.send_json({
-                                "type": "input_audio_buffer.appended",
-                                "length": len(message["delta"])
-                            })
+                        forward = [message["delta"]]
+                        if gate:
+                            samples = np.frombuffer(base64.b64decode(message["delta"]), dtype=np.int16)
+                            forward = gate.process(message["delta"], samples)
+                            summary = gate.report()
+                            if summary:
+                                print(f"[{timestamp()}] {summary}")
+                        for delta in forward:
+                            if encoder:
+                                delta = encoder.encode(delta)
+                            audio_event = {
+                                "type": "input_audio_buffer.append",
+                                "audio": delta
+                            }
+                            await ws_openai.send_json(audio_event)
+                            # Summarized for web clients by report_appended
+                            app['appended']['length'] += len(delta)
+                            app['appended']['count'] += 1
+                if gate:
+                    print(f"[{timestamp()}] {gate.stats()}")
 
             async def openai_listener():
                 print(f"[{timestamp()}] Starting OpenAI event listener")
@@ -98,8 +160,7 @@ async def openai_handler(app):
                     if msg.type == aiohttp.WSMsgType.TEXT:
                         event = json.loads(msg.data)
                         # Relay OpenAI events to all connected clients
-                        for client_ws in app['websockets']:
-                            await client_ws.send_json(event)
+                        broadcast(app, event)
                     elif msg.type == aiohttp.WSMsgType.ERROR:
                         print(f'OpenAI WebSocket error: {ws_openai.exception()}')
                         break
@@ -109,14 +170,17 @@ async def openai_handler(app):
 async def on_startup(app):
     app['websockets'] = set()
     app['ws_manager'] = OpenAIWSManager()
+    app['appended'] = {"length": 0, "count": 0}
     app['openai_task'] = asyncio.create_task(openai_handler(app))
+    app['report_task'] = asyncio.create_task(report_appended(app))
 
 async def on_shutdown(app):
     try:
+        app['report_task'].cancel()
         # Create a copy of the websockets set
         websockets = set(app['websockets'])
-        for ws in websockets:
-            await ws.close()
+        for client in websockets:
+            await client.close()
         
         openai_ws = await app['ws_manager'].get_ws()
         if openai_ws and not openai_ws.closed:
@@ -132,6 +196,17 @@ async def on_shutdown(app):
         print(f"Error during shutdown: {e}")
 
 def main():
+    parser = argparse.ArgumentParser(description="Web chat about a PCMux stream, powered by OpenAI's Realtime API")
+    parser.add_argument("--url", default=WEBSOCKET_URL,
+                        help="Realtime API websocket endpoint (default: $OPENAI_REALTIME_URL or the OpenAI endpoint)")
+    parser.add_argument("--port", type=int, default=8088, help="Port for the web interface (default: 8088)")
+    parser.add_argument("--uplink-format", choices=UPLINK_FORMATS, default="pcm16",
+                        help="Audio encoding sent to the Realtime API, g711 formats are 8 kHz at a sixth of the size (default: pcm16)")
+    parser.add_argument("--client-queue", type=int, default=256,
+                        help="Events a browser may fall behind before it is disconnected (default: 256)")
+    add_gate_arguments(parser)
+    args = parser.parse_args()
+
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         print("Error: OPENAI_API_KEY environment variable not set.")
@@ -139,6 +214,10 @@ def main():
 
     app = web.Application()
     app['api_key'] = api_key
+    app['url'] = args.url
+    app['gate'] = create_gate(args, 24000)
+    app['uplink_format'] = args.uplink_format
+    app['client_queue'] = args.client_queue
     app.add_routes([
         web.get('/', handle_index),
         web.get('/ws', websocket_handler),
@@ -147,7 +226,7 @@ def main():
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
 
-    web.run_app(app, port=8088)
+    web.run_app(app, port=args.port)
 
 if __name__ == "__main__":
     main()
@@ -9,6 +9,8 @@ import io
 from aiohttp import web
 from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
 
+from pcmux_stdio import EventWriter
+
 logging.basicConfig(
     level=logging.INFO,
     stream=sys.stderr,
@@ -17,6 +19,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 pcs = set()
+stdout = EventWriter()
 
 SCREEN_MAX = 1024
 SCREEN_RATE = 30
@@ -57,7 +60,7 @@ async def offer(request):
                         "type": "pcmux.audio.delta",
                         "delta": audio_base64
                     }
-                    print(json.dumps(message), flush=True, file=sys.stdout)
+                    await stdout.write(message)
             except Exception as e:
                 logger.error(f"Error processing audio track: {e}")
                 break
@@ -81,7 +84,7 @@ async def offer(request):
                         "mime": "image/png",
                         "data": img_base64
                     }
-                    print(json.dumps(message), flush=True)
+                    await stdout.write(message)
             except Exception as e:
                 logger.error(f"Error processing video track: {e}")
                 break
@@ -105,6 +108,9 @@ async def offer(request):
         text=json.dumps(response)
     )
 
+async def on_startup(app):
+    await stdout.open()
+
 async def on_shutdown(app):
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
@@ -114,6 +120,7 @@ def main():
     app = web.Application()
     app.router.add_get('/', index)
     app.router.add_post('/offer', offer)
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     logger.info("Starting WebRTC server on port 8080")
     web.run_app(app, port=8080, print=lambda *args: logger.info(*args))
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import asyncio
-import json
 import uuid
 import av
 import base64
@@ -13,6 +12,8 @@ from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
 from aiortc.sdp import candidate_from_sdp
 from aiortc.mediastreams import MediaStreamError
 
+from pcmux_stdio import EventWriter
+
 SERVER_PORT = 8080
 WHIP_ENDPOINT = "/whip"
 SCREEN_MAX = 1024
@@ -22,6 +23,7 @@ SCREEN_RATE = 30
 pcs = set()
 pcs_by_resource_id = {}
 handlers_by_resource_id = {}
+stdout = EventWriter()
 
 def log(msg):
     """Log to stderr"""
@@ -61,7 +63,7 @@ class WHIPHandler:
                         "type": "pcmux.audio.delta",
                         "delta": audio_base64
                     }
-                    print(json.dumps(message), flush=True)
+                    await stdout.write(message)
 
             except MediaStreamError:
                 log(f"Audio stream ended for handler {self.id}")
@@ -93,7 +95,7 @@ class WHIPHandler:
                         "mime": "image/png",
                         "data": img_base64
                     }
-                    print(json.dumps(message), flush=True)
+                    await stdout.write(message)
                     
             except MediaStreamError:
                 log(f"Video stream ended for handler {self.id}")
@@ -251,6 +253,9 @@ async def save_frames(track):
             log(f"Error receiving frame: {e}")
             break
 
+async def on_startup(app):
+    await stdout.open()
+
 async def on_shutdown(app):
     coros = [handler.close() for handler in handlers_by_resource_id.values()]
     await asyncio.gather(*coros)
@@ -263,6 +268,7 @@ def main():
     app.router.add_post(WHIP_ENDPOINT, handle_whip)
     app.router.add_patch(f"{WHIP_ENDPOINT}/{{id}}", handle_patch)
     app.router.add_delete(f"{WHIP_ENDPOINT}/{{id}}", handle_delete)
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     
     log(f"Starting WHIP server at http://127.0.0.1:{SERVER_PORT}{WHIP_ENDPOINT}")
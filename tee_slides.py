@@ -1,12 +1,20 @@
 import sys
 import json
 import base64
+import bisect
+import hashlib
 import os
+import re
 import argparse
 import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
 
+import numpy as np
 from PIL import Image
 import imagehash
 import google.generativeai as genai
@@ -16,8 +24,15 @@ def parse_arguments():
     parser.add_argument('directory', type=str, nargs='?', default=os.getcwd(), help='Target directory for saving slides (default: current working directory)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose debugging')
     parser.add_argument('-s', '--sensitivity', type=int, default=5, help='Sensitivity for change detection (1-10)')
+    parser.add_argument('--ssim-threshold', type=float, default=0.9, help='Region similarity below which a borderline change counts as a new slide, 0 disables the region check (default: 0.9)')
+    parser.add_argument('--min-change-area', type=float, default=0.005, help='Fraction of the frame that must change before the region check runs, keeps cursors and small animations out (default: 0.005)')
     parser.add_argument('-g', '--gemini', action='store_true', help='Enable Gemini API for enhanced slide change detection')
-    return parser.parse_args()
+    parser.add_argument('--gemini-batch', type=int, default=4, help='Most candidate frames sent in one Gemini request while it is busy (default: 4)')
+    parser.add_argument('--lookup', type=str, metavar='TIME', help='Print the slide shown at TIME (epoch seconds or ISO date) from the manifest in the directory, then exit')
+    args = parser.parse_args()
+    if args.gemini_batch < 1:
+        parser.error("--gemini-batch must be at least 1")
+    return args
 
 def setup_logging(verbose):
     level = logging.DEBUG if verbose else logging.INFO
@@ -26,24 +41,51 @@ def setup_logging(verbose):
 def ensure_slide_directory(directory):
     os.makedirs(directory, exist_ok=True)
 
-def save_image(image, directory):
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-    filepath = os.path.join(directory, f'{timestamp}.png')
-    image.save(filepath)
+EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp'}
+
+def slide_path(directory, digest, mime):
+    # Named by content, so a byte-identical frame maps to the file already written
+    return os.path.join(directory, digest[:20] + EXTENSIONS.get(mime, '.png'))
+
+def save_image(payload, filepath):
+    if os.path.exists(filepath):
+        return
+    # Written under a temporary name first so a crash never leaves a partial slide
+    partial = filepath + '.part'
+    with open(partial, 'wb') as f:
+        f.write(payload)
+    os.replace(partial, filepath)
     logging.info(f"Saved slide: {filepath}")
 
-def upload_to_gemini(image):
-    image_bytes = BytesIO()
-    image.save(image_bytes, format='PNG')
-    image_bytes = image_bytes.getvalue()
+def manifest_path(directory):
+    return os.path.join(directory, 'manifest.jsonl')
 
-    file = genai.upload_file_bytes(image_bytes, mime_type='image/png')
-    return file.uri
+def lookup_slide(directory, when):
+    # The manifest is appended in arrival order, so its times are already sorted
+    entries = []
+    with open(manifest_path(directory)) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    times = [entry['time'] for entry in entries]
+    position = bisect.bisect_right(times, when)
+    if position == 0:
+        return None
+    return entries[position - 1]
 
-def use_gemini_for_comparison(prev_image, curr_image, prompt):
-    prev_image_uri = upload_to_gemini(prev_image)
-    curr_image_uri = upload_to_gemini(curr_image)
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
 
+def upload_to_gemini(payload, mime):
+    file = genai.upload_file_bytes(payload, mime_type=mime)
+    return file.uri
+
+def use_gemini_for_comparison(image_uris, prompt):
     model = genai.GenerativeModel(
         model_name="gemini-1.5-flash-8b",
         generation_config={
@@ -56,86 +98,442 @@ def use_gemini_for_comparison(prev_image, curr_image, prompt):
         system_instruction=prompt,
     )
 
+    message = list(image_uris)
+    if len(image_uris) > 2:
+        message.append(f"These are {len(image_uris)} consecutive frames. Compare each frame with the one before it "
+                       f"and give a separate <decision> for each of the {len(image_uris) - 1} frames after the first, in order.")
+
     chat_session = model.start_chat()
-    response = chat_session.send_message([prev_image_uri, curr_image_uri])
+    response = chat_session.send_message(message)
 
     logging.debug(f"Gemini API response: {response.text}")
 
-    if "<decision>" in response.text:
-        decision_section = response.text.split("<decision>")[1].split("</decision>")[0].strip()
-        if "SAVE" in decision_section:
-            return True
-    return False
+    decisions = ["SAVE" in decision for decision in re.findall(r"<decision>(.*?)</decision>", response.text, re.DOTALL)]
+    return (decisions + [False] * len(image_uris))[:len(image_uris) - 1]
+
+class GeminiJudge:
+    # Uploads each distinct frame once and remembers decisions per pair of frames. Only
+    # used from the Gemini thread
+    def __init__(self, prompt, cache_size=256, upload_lifetime=24 * 3600):
+        self.prompt = prompt
+        self.cache_size = cache_size
+        self.upload_lifetime = upload_lifetime
+        self.uris = OrderedDict()
+        self.decisions = OrderedDict()
+        self.uploads = 0
+        self.calls = 0
+        self.remembered = 0
+
+    @staticmethod
+    def remember(cache, key, value, size):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > size:
+            cache.popitem(last=False)
+
+    def uri(self, frame):
+        # Uploaded files expire on the Gemini side after two days
+        cached = self.uris.get(frame.digest)
+        if cached and time.time() - cached[1] < self.upload_lifetime:
+            self.uris.move_to_end(frame.digest)
+            return cached[0]
+        uri = upload_to_gemini(frame.payload, frame.mime)
+        self.uploads += 1
+        self.remember(self.uris, frame.digest, (uri, time.time()), self.cache_size)
+        return uri
+
+    def compare(self, frames):
+        pairs = [(reference.digest, frame.digest) for reference, frame in zip(frames, frames[1:])]
+        if all(pair in self.decisions for pair in pairs):
+            self.remembered += len(pairs)
+            return [self.decisions[pair] for pair in pairs]
+        self.calls += 1
+        decisions = use_gemini_for_comparison([self.uri(frame) for frame in frames], self.prompt)
+        for pair, decision in zip(pairs, decisions):
+            self.remember(self.decisions, pair, decision, self.cache_size)
+        return decisions
+
+    def summary(self):
+        return f"Gemini: {self.calls} requests, {self.uploads} uploads, {self.remembered} decisions reused"
+
+class Frame:
+    # Decoded frame with features computed on demand, cheapest first
+    def __init__(self, data, mime='image/png', received=None, offset=None, tiny_width=96, medium_width=480):
+        self.payload = base64.b64decode(data)
+        self.digest = hashlib.sha256(self.payload).hexdigest()
+        self.mime = mime
+        self.received = received
+        self.offset = offset
+        image = Image.open(BytesIO(self.payload))
+        # Lets JPEG frames decode at reduced size; PNG frames decode fully either way
+        image.draft('L', (medium_width, medium_width))
+        self.gray = image.convert('L')
+        self.tiny_image = self.gray.reduce(max(1, self.gray.width // tiny_width))
+        self.tiny = np.asarray(self.tiny_image, dtype=np.int16)
+        self.medium_width = medium_width
+        self._hash = None
+        self._medium = None
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = imagehash.average_hash(self.tiny_image)
+        return self._hash
+
+    @property
+    def medium(self):
+        if self._medium is None:
+            medium = self.gray.reduce(max(1, self.gray.width // self.medium_width))
+            self._medium = np.asarray(medium, dtype=np.float32)
+        return self._medium
+
+def block_ssim(a, b, block=8):
+    # Mean SSIM over non-overlapping blocks, all blocks at once
+    h = a.shape[0] // block * block
+    w = a.shape[1] // block * block
+    if h == 0 or w == 0:
+        return 1.0
+    a = a[:h, :w].reshape(h // block, block, w // block, block).swapaxes(1, 2).reshape(-1, block * block)
+    b = b[:h, :w].reshape(h // block, block, w // block, block).swapaxes(1, 2).reshape(-1, block * block)
+    mu_a = a.mean(axis=1)
+    mu_b = b.mean(axis=1)
+    cov = ((a - mu_a[:, None]) * (b - mu_b[:, None])).mean(axis=1)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    ssim = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (a.var(axis=1) + b.var(axis=1) + c2))
+    return float(ssim.mean())
+
+class ChangeDetector:
+    # Tiny grayscale diff, then average hash, then SSIM over the changed region only when
+    # the hash is borderline or blind to a sizeable change. Most frames of a static slide
+    # exit at the first stage
+    def __init__(self, sensitivity=5, ssim_threshold=0.9, min_area=0.005, band=2, pixel_threshold=12,
+                 report_every=300):
+        self.sensitivity = sensitivity
+        self.ssim_threshold = ssim_threshold
+        self.min_area = min_area
+        self.band = band
+        self.pixel_threshold = pixel_threshold
+        self.report_every = report_every
+        self.stats = {stage: [0, 0.0] for stage in ("decode", "diff", "hash", "ssim")}
+        self.frames = 0
+
+    def record(self, stage, started):
+        self.stats[stage][0] += 1
+        self.stats[stage][1] += time.perf_counter() - started
+
+    def decode(self, data, mime, received, offset):
+        started = time.perf_counter()
+        frame = Frame(data, mime, received, offset)
+        self.record("decode", started)
+        self.frames += 1
+        if self.frames % self.report_every == 0:
+            logging.debug(self.summary())
+        return frame
+
+    def same(self, previous_tiny, current_tiny):
+        # First stage only, for confirming a hash match against an earlier slide
+        if previous_tiny.shape != current_tiny.shape:
+            return False
+        return not (np.abs(previous_tiny - current_tiny) > self.pixel_threshold).any()
+
+    def changed(self, previous, current):
+        started = time.perf_counter()
+        if previous.tiny.shape != current.tiny.shape:
+            self.record("diff", started)
+            return "size"
+        changed_pixels = np.abs(previous.tiny - current.tiny) > self.pixel_threshold
+        self.record("diff", started)
+        if not changed_pixels.any():
+            return None
+
+        started = time.perf_counter()
+        difference = previous.hash - current.hash
+        self.record("hash", started)
+        logging.debug(f"Hash difference: {difference}")
+        area = changed_pixels.mean()
+        if difference >= self.sensitivity + self.band or not self.ssim_threshold or area < self.min_area:
+            # Clear hash decision, or too little changed for the region check to be trusted
+            if difference >= self.sensitivity:
+                logging.info(f"Significant hash change detected (diff={difference}).")
+                return "hash"
+            return None
+
+        # Borderline hash, or a change the hash cannot see such as a new line of text.
+        # Region similarity decides either way
+        started = time.perf_counter()
+        rows = np.flatnonzero(changed_pixels.any(axis=1))
+        cols = np.flatnonzero(changed_pixels.any(axis=0))
+        scale = previous.medium.shape[1] / previous.tiny.shape[1]
+        top = max(int(rows[0] * scale) - 8, 0)
+        bottom = int((rows[-1] + 1) * scale) + 8
+        left = max(int(cols[0] * scale) - 8, 0)
+        right = int((cols[-1] + 1) * scale) + 8
+        ssim = block_ssim(previous.medium[top:bottom, left:right], current.medium[top:bottom, left:right])
+        self.record("ssim", started)
+        logging.debug(f"Region SSIM: {ssim:.3f}")
+        if ssim < self.ssim_threshold:
+            logging.info(f"Significant region change detected (ssim={ssim:.3f}, diff={difference}).")
+            return "region"
+        if difference >= self.sensitivity:
+            logging.debug(f"Hash change rejected, region unchanged (ssim={ssim:.3f}, diff={difference}).")
+        return None
+
+    def summary(self):
+        parts = [f"{stage} {count} in {seconds * 1000 / max(count, 1):.1f}ms avg"
+                 for stage, (count, seconds) in self.stats.items()]
+        return f"Change detection over {self.frames} frames: " + ", ".join(parts)
+
+class SlideIndex:
+    # Hashes of every saved slide packed into uint64s, so a frame is compared against all
+    # of them with one XOR and popcount. Only the thumbnail is kept to confirm a match
+    def __init__(self, max_distance=2):
+        self.max_distance = max_distance
+        self.hashes = np.zeros(64, dtype=np.uint64)
+        self.slides = []
+
+    @staticmethod
+    def pack(image_hash):
+        return np.packbits(image_hash.hash.flatten()).view('>u8')[0]
+
+    def add(self, frame, path):
+        if len(self.slides) == len(self.hashes):
+            self.hashes = np.concatenate([self.hashes, np.zeros_like(self.hashes)])
+        self.hashes[len(self.slides)] = self.pack(frame.hash)
+        self.slides.append((frame.tiny, path))
+
+    def find(self, frame, detector):
+        count = len(self.slides)
+        if count == 0:
+            return None
+        xor = self.hashes[:count] ^ self.pack(frame.hash)
+        distances = np.unpackbits(xor.view(np.uint8).reshape(count, 8), axis=1).sum(axis=1)
+        for i in np.argsort(distances, kind='stable'):
+            if distances[i] > self.max_distance:
+                break
+            tiny, path = self.slides[i]
+            if detector.same(tiny, frame.tiny):
+                return path
+        return None
+
+class FrameMailbox:
+    # Single slot holding only the newest frame, analysis skips frames it could not keep up with
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.closed = False
+        self.replaced = 0
+
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None:
+                self.replaced += 1
+            self.frame = frame
+            self.condition.notify()
+
+    def get(self, timeout):
+        # Still waits once closed, so callers polling other work in between do not spin
+        with self.condition:
+            if self.frame is None:
+                self.condition.wait(timeout)
+            frame, self.frame = self.frame, None
+            return frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+class SlideAnalyzer:
+    # Runs on its own thread; Gemini checks and file writes run on executors so a slow
+    # verification never holds up hashing of newer frames
+    def __init__(self, args, mailbox, gemini_prompt=None):
+        self.args = args
+        self.mailbox = mailbox
+        self.gemini_prompt = gemini_prompt
+        self.detector = ChangeDetector(args.sensitivity, args.ssim_threshold, args.min_change_area)
+        self.previous = None
+        self.index = SlideIndex()
+        self.duplicates = 0
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.manifest = open(manifest_path(args.directory), 'a')
+        self.gemini_pool = ThreadPoolExecutor(max_workers=1) if gemini_prompt else None
+        self.judge = GeminiJudge(gemini_prompt) if gemini_prompt else None
+        self.verifying = None
+        self.waiting = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def accept(self, frame, reason):
+        self.previous = frame
+        path = slide_path(self.args.directory, frame.digest, frame.mime)
+        self.index.add(frame, path)
+        self.writer.submit(self.save, frame.payload, path)
+        self.writer.submit(self.record, frame, path, reason)
+
+    def revisit(self, frame):
+        # Back on a slide saved earlier, point at it instead of saving or verifying again
+        path = self.index.find(frame, self.detector)
+        if path is None:
+            return False
+        logging.info(f"Returned to earlier slide: {path}")
+        self.previous = frame
+        self.duplicates += 1
+        self.writer.submit(self.record, frame, path, "revisit")
+        return True
+
+    def save(self, payload, path):
+        try:
+            save_image(payload, path)
+        except OSError as e:
+            logging.error(f"Failed to save slide: {e}")
+
+    def record(self, frame, path, reason):
+        entry = {"time": frame.received, "offset": frame.offset, "file": os.path.basename(path),
+                 "hash": str(frame.hash), "reason": reason}
+        try:
+            self.manifest.write(json.dumps(entry) + "\n")
+            self.manifest.flush()
+        except OSError as e:
+            logging.error(f"Failed to update manifest: {e}")
+
+    def verify(self, frame):
+        if self.verifying is not None:
+            # Candidates queue up while Gemini is busy and go out together in the next request
+            self.waiting.append(frame)
+            del self.waiting[:-self.args.gemini_batch]
+            return
+        self.submit([frame])
+
+    def submit(self, candidates):
+        logging.debug(f"Using Gemini API for additional check of {len(candidates)} frames.")
+        frames = [self.previous] + candidates
+        self.verifying = (self.gemini_pool.submit(self.judge.compare, frames), frames)
+
+    def poll_gemini(self):
+        if self.verifying is None or not self.verifying[0].done():
+            return
+        future, frames = self.verifying
+        self.verifying = None
+        try:
+            decisions = future.result()
+        except Exception as e:
+            logging.error(f"Gemini API error: {e}")
+            decisions = []
+        for frame, gemini_decision in zip(frames[1:], decisions):
+            if gemini_decision:
+                logging.info("Gemini API decision: SAVE")
+                logging.info("Saving new slide.")
+                self.accept(frame, "gemini")
+            else:
+                logging.info("Gemini API decision: SKIP")
+
+        waiting, self.waiting = self.waiting, []
+        candidates = []
+        for frame in waiting:
+            reference = candidates[-1] if candidates else self.previous
+            if not self.detector.changed(reference, frame):
+                continue
+            if self.revisit(frame):
+                candidates = []
+                continue
+            candidates.append(frame)
+        if candidates:
+            self.submit(candidates)
+
+    def analyze(self, data, mime, received, offset):
+        frame = self.detector.decode(data, mime, received, offset)
+
+        if self.previous is None:
+            logging.debug("First image received. Saving as initial slide.")
+            self.accept(frame, "first")
+            return
+
+        reason = self.detector.changed(self.previous, frame)
+        if reason:
+            if self.revisit(frame):
+                return
+            if self.gemini_pool:
+                self.verify(frame)
+            else:
+                logging.info("Saving new slide.")
+                self.accept(frame, reason)
+        else:
+            logging.debug("No significant change detected.")
+
+    def run(self):
+        while True:
+            item = self.mailbox.get(timeout=0.2)
+            if self.gemini_pool:
+                self.poll_gemini()
+            if item is None:
+                if self.mailbox.closed and self.verifying is None and not self.waiting:
+                    break
+                continue
+            try:
+                self.analyze(*item)
+            except base64.binascii.Error:
+                logging.error("Failed to decode base64 image data.")
+            except Exception as e:
+                logging.error(f"Unexpected error: {e}")
+        if self.mailbox.replaced:
+            logging.debug(f"Skipped {self.mailbox.replaced} frames that arrived during analysis")
+        logging.info(self.detector.summary())
+        if self.judge:
+            logging.info(self.judge.summary())
+        if self.duplicates:
+            logging.info(f"Recognized {self.duplicates} returns to earlier slides of {len(self.index.slides)} saved")
+        self.writer.shutdown(wait=True)
+        self.manifest.close()
 
 def main():
     args = parse_arguments()
     setup_logging(args.verbose)
-    ensure_slide_directory(args.directory)
 
-    previous_hash = None
-    previous_image = None
-    sensitivity = args.sensitivity
+    if args.lookup:
+        entry = lookup_slide(args.directory, parse_time(args.lookup))
+        if entry is None:
+            logging.error(f"No slide was shown at {args.lookup}")
+            sys.exit(1)
+        print(os.path.join(args.directory, entry["file"]))
+        return
 
-    if args.use_gemini:
+    ensure_slide_directory(args.directory)
+
+    gemini_prompt = None
+    if args.gemini:
         genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
         with open('tee_slides.txt', 'r') as prompt_file:
             gemini_prompt = prompt_file.read()
         logging.debug("Gemini API enabled for enhanced slide detection.")
 
-    for line in sys.stdin:
-        try:
-            # Pass all messages through
-            print(line, end='', flush=True)
-            
-            message = json.loads(line)
-            if message.get("type") != "pcmux.video.frame":
-                continue
-            
-            image_data = base64.b64decode(message.get("data"))
-            image = Image.open(BytesIO(image_data)).convert('RGB')
-            current_hash = imagehash.average_hash(image)
-
-            if previous_hash is None:
-                logging.debug("First image received. Saving as initial slide.")
-                save_image(image, args.directory)
-                previous_hash = current_hash
-                if args.use_gemini:
-                    previous_image = image
-                continue
-
-            difference = previous_hash - current_hash
-            logging.debug(f"Hash difference: {difference}")
+    mailbox = FrameMailbox()
+    analyzer = SlideAnalyzer(args, mailbox, gemini_prompt)
+    analyzer.start()
 
-            if difference >= sensitivity:
-                logging.info(f"Significant hash change detected (diff={difference}).")
-                save_slide = True
-
-                if args.use_gemini:
-                    logging.debug("Using Gemini API for additional check.")
-                    gemini_decision = use_gemini_for_comparison(previous_image, image, gemini_prompt)
-                    if gemini_decision:
-                        logging.info("Gemini API decision: SAVE")
-                    else:
-                        logging.info("Gemini API decision: SKIP")
-                    save_slide = gemini_decision
-
-                if save_slide:
-                    logging.info("Saving new slide.")
-                    save_image(image, args.directory)
-                    previous_hash = current_hash
-                    if args.use_gemini:
-                        previous_image = image
-                else:
-                    logging.debug("Decided not to save the slide.")
-            else:
-                logging.debug("No significant hash change detected.")
+    stdout = sys.stdout.buffer
+    offset = 0
+    for line in sys.stdin.buffer:
+        # Pass all messages through before looking at them
+        stdout.write(line)
+        stdout.flush()
+        offset += len(line)
 
+        if b'"pcmux.video.frame"' not in line:
+            continue
+        try:
+            message = json.loads(line)
         except json.JSONDecodeError:
             logging.error("Failed to decode JSON from input.")
-        except base64.binascii.Error:
-            logging.error("Failed to decode base64 image data.")
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
+            continue
+        if message.get("type") == "pcmux.video.frame":
+            # Byte offset of the frame's line in the stream, for locating it in a recording
+            mailbox.put((message.get("data"), message.get("mime", "image/png"), time.time(), offset - len(line)))
+
+    mailbox.close()
+    analyzer.thread.join()
 
 if __name__ == "__main__":
     main()
@@ -5,12 +5,14 @@ import time
 import signal
 import argparse
 import base64
-import wave
 import logging
-import io
+import string
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
-import torch
 from dotenv import load_dotenv
 
 # For local STT:
@@ -20,13 +22,14 @@ from faster_whisper import WhisperModel
 # For VAD and speaker detection:
 # Pyannote Audio: https://github.com/pyannote/pyannote-audio
 # We assume pre-trained models are available locally or via huggingface.
-from pyannote.audio import Pipeline
+from pcmux_diarize import REUSE_OVERLAP, IncrementalDiarizer, diarization_model_names, load_diarization_models
+from pcmux_speakers import load_speaker_index
+from pcmux_vad import COMMIT, SKIP, add_vad_arguments, create_segmenter
+from pcmux_cache import ResultCache
+from pcmux_audio import read_all_audio
 
 load_dotenv()
 
-# Set up logging to stderr
-logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='[%(levelname)s] %(message)s')
-
 interrupted = False
 
 def signal_handler(sig, frame):
@@ -35,135 +38,596 @@ def signal_handler(sig, frame):
     logging.info("Interrupted, exiting...")
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
+
+def setup_logging(level=logging.DEBUG):
+    # Set up logging to stderr. Called by the scripts, not on import, so server_transcribe.py
+    # and the offline workers choose their own
+    logging.basicConfig(stream=sys.stderr, level=level, format='[%(levelname)s] %(message)s')
+
+
+def parse_model_ladder(spec):
+    # "medium.en:5,small.en,base.en" -> [("medium.en", 5), ("small.en", 1), ("base.en", 1)]
+    ladder = []
+    for entry in spec.split(","):
+        name, _, beam_size = entry.strip().partition(":")
+        if name:
+            ladder.append((name, int(beam_size) if beam_size else 1))
+    return ladder
+
+
+class Models:
+    def __init__(self, workers=1, cpu_threads=0, ladder=None):
+        # Initialize local STT (Faster Whisper) and pyannote pipelines
+        # Load the Whisper models, largest first (change model size/path as needed)
+        # num_workers lets that many threads transcribe with a model in parallel,
+        # each using cpu_threads (0 lets CTranslate2 decide)
+        if not ladder:
+            ladder = [(os.getenv("WHISPER_MODEL_PATH", "medium.en"), 1)]
+        # All sizes are loaded up front so stepping down never waits on a load
+        self.whisper_models = []
+        for model_path, beam_size in ladder:
+            model = WhisperModel(
+                model_path, 
+                device="cpu", 
+                compute_type="int8",
+                cpu_threads=cpu_threads,
+                num_workers=workers
+            )
+            self.whisper_models.append((model_path, model, beam_size))
+        self.workers = workers
+        self.transcribe_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whisper")
+
+        # Pyannote pipeline for speaker diarization plus an embedding model for
+        # keeping speaker labels stable across windows (DIARIZATION_MODEL, EMBEDDING_MODEL)
+        self.pipeline, self.embedding = load_diarization_models()
+
+        # Shared by every processor using these models
+        self.diarization_lock = threading.Lock()
+
+
+def print_event(event):
+    print(json.dumps(event))
+    sys.stdout.flush()
+
+
+class ModelSelector:
+    # Steps down the model ladder when the stream falls behind and back up once idle
+    def __init__(self, whisper_models, max_lag=5.0, idle_rtf=0.3, down_cooldown=10.0, up_cooldown=30.0):
+        self.whisper_models = whisper_models
+        self.max_lag = max_lag
+        self.idle_rtf = idle_rtf
+        self.down_cooldown = down_cooldown
+        self.up_cooldown = up_cooldown
+        self.level = 0
+        self.rtf = 0.0
+        self.last_switch = time.time()
+        self.lock = threading.Lock()
+
+    def current(self):
+        return self.level, self.whisper_models[self.level][0], self.whisper_models[self.level][2]
+
+    def transcribe(self, audio_np: np.ndarray, sample_rate, level=None, **kwargs):
+        name, model, beam_size = self.whisper_models[self.level if level is None else level]
+        started = time.time()
+        segments, _ = model.transcribe(audio_np, beam_size=beam_size, **kwargs)
+        # Decoding happens while the generator is consumed
+        segments = list(segments)
+        elapsed = time.time() - started
+        if len(audio_np) > 0:
+            with self.lock:
+                self.rtf = 0.8 * self.rtf + 0.2 * elapsed / (len(audio_np) / sample_rate)
+        return segments
+
+    def adjust(self, lag):
+        if len(self.whisper_models) < 2:
+            return
+        since_switch = time.time() - self.last_switch
+        level = self.level
+        if lag > self.max_lag and since_switch >= self.down_cooldown and level < len(self.whisper_models) - 1:
+            level += 1
+        elif lag < self.max_lag / 4 and self.rtf < self.idle_rtf and since_switch >= self.up_cooldown and level > 0:
+            level -= 1
+        if level != self.level:
+            previous = self.whisper_models[self.level]
+            current = self.whisper_models[level]
+            logging.info(f"Switching whisper model {previous[0]} (beam {previous[2]}) -> {current[0]} (beam {current[2]}), "
+                         f"lag {lag:.1f}s, real-time factor {self.rtf:.2f}")
+            self.level = level
+            self.last_switch = time.time()
+
+
+def normalize_word(word):
+    return word.strip().strip(string.punctuation).lower()
+
+
+class StreamingTranscriber:
+    # Re-decodes the unconfirmed audio as it grows; words are promoted to
+    # pcmux.text.chunk once two consecutive hypotheses agree on them, the rest
+    # is reported as pcmux.text.partial
+    def __init__(self, selector, pool, diarizer, sample_rate, emit, interval=1.0, max_buffer=20.0,
+                 word_timestamps=False):
+        self.selector = selector
+        self.word_timestamps = word_timestamps
+        self.pool = pool
+        self.diarizer = diarizer
+        self.sample_rate = sample_rate
+        self.emit = emit
+        self.interval = int(interval * sample_rate)
+        self.max_buffer = int(max_buffer * sample_rate)
+
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.buffer_offset = 0
+        self.samples_since_decode = 0
+        self.confirmed_text = ""
+        self.hypothesis = []
+        self.decoding = None
+
+    def append(self, audio_np: np.ndarray):
+        self.buffer = np.concatenate([self.buffer, audio_np])
+        self.samples_since_decode += len(audio_np)
+
+    def prompt(self):
+        # Confirmed text conditions the decoder so only the unconfirmed audio is re-decoded
+        return self.confirmed_text[-200:] or None
+
+    def decode(self, audio_np, offset, prompt):
+        segments = self.selector.transcribe(audio_np, self.sample_rate, language="en", word_timestamps=True,
+                                            initial_prompt=prompt, condition_on_previous_text=False)
+        words = []
+        for segment in segments:
+            for word in segment.words or []:
+                words.append((offset + int(word.start * self.sample_rate),
+                              offset + int(word.end * self.sample_rate), word.word))
+        return words
+
+    def poll(self):
+        if self.decoding is not None:
+            if not self.decoding.done():
+                return
+            try:
+                self.update(self.decoding.result())
+            except Exception as e:
+                logging.error(f"Partial transcription failed: {e}")
+            self.decoding = None
+
+        # At most one decode in flight, so a slow host simply decodes less often
+        if self.samples_since_decode >= self.interval and len(self.buffer) > 0:
+            self.samples_since_decode = 0
+            self.decoding = self.pool.submit(self.decode, self.buffer.copy(), self.buffer_offset, self.prompt())
+
+    def update(self, words):
+        # Words before the current buffer start were confirmed while decoding
+        words = [w for w in words if w[0] >= self.buffer_offset]
+        agreed = 0
+        for new, old in zip(words, self.hypothesis):
+            if normalize_word(new[2]) != normalize_word(old[2]):
+                break
+            agreed += 1
+
+        confirmed = words[:agreed]
+        if len(self.buffer) > self.max_buffer and len(words) > agreed + 1:
+            # Nothing stable for too long, confirm all but the last word
+            confirmed = words[:-1]
+        self.hypothesis = words[len(confirmed):]
+
+        if confirmed:
+            self.confirm(confirmed)
+        text = "".join(w[2] for w in self.hypothesis).strip()
+        if text:
+            self.emit({
+                "type": "pcmux.text.partial",
+                "text": text
+            })
+
+    def confirm(self, words):
+        end = words[-1][1]
+        start = min(words[0][0], end)
+        text = "".join(w[2] for w in words).strip()
+        if text:
+            span = self.buffer[max(start - self.buffer_offset, 0):end - self.buffer_offset]
+            speaker = self.diarizer.label(span, start) if len(span) > 0 else "UNKNOWN"
+            event = {
+                "type": "pcmux.text.chunk",
+                "speaker": speaker,
+                "text": text,
+                "start": start,
+                "end": end
+            }
+            if self.word_timestamps:
+                event["words"] = [{"word": w[2].strip(), "start": w[0], "end": w[1]} for w in words]
+            self.emit(event)
+            self.confirmed_text = (self.confirmed_text + " " + text).strip()
+
+        # Drop the confirmed audio so the next decode only covers unconfirmed speech
+        trim = min(max(end - self.buffer_offset, 0), len(self.buffer))
+        self.buffer = self.buffer[trim:]
+        self.buffer_offset += trim
+
+    def finalize(self):
+        # End of an utterance: confirm whatever the last full decode says
+        if self.decoding is not None:
+            self.decoding.result()
+            self.decoding = None
+        if len(self.buffer) > 0:
+            words = self.decode(self.buffer.copy(), self.buffer_offset, self.prompt())
+            if words:
+                self.confirm(words)
+        self.skip()
+
+    def skip(self):
+        if self.decoding is not None:
+            self.decoding.cancel()
+            self.decoding = None
+        self.buffer_offset += len(self.buffer)
+        self.buffer = self.buffer[:0]
+        self.hypothesis = []
+        self.samples_since_decode = 0
 
 
 class AudioProcessor:
-    def __init__(self, commit_interval=5.0, verbose=False, sample_rate=16000):
+    def __init__(self, commit_interval=5.0, verbose=False, sample_rate=16000, overlap=REUSE_OVERLAP, speaker_threshold=0.5,
+                 segmenter=None, models=None, emit=print_event, partial_interval=None, word_timestamps=False,
+                 max_lag=5.0, cache=None, speaker_index=None):
         self.commit_interval = commit_interval
+        self.emit = emit
         self.verbose = verbose
         self.sample_rate = sample_rate
+        self.word_timestamps = word_timestamps
+
+        # Optional on-disk cache of diarization and transcription results per window
+        self.cache = cache
 
         # Buffer to store audio data between commits
-        self.audio_buffer = io.BytesIO()
-        self.wav_writer = None
+        self.audio_buffer = bytearray()
         self.last_commit_time = time.time()
 
-        # Initialize local STT (Faster Whisper) and pyannote pipelines
-        # Load a Whisper model (change model size/path as needed)
-        model_path = os.getenv("WHISPER_MODEL_PATH", "medium.en")
-        self.whisper_model = WhisperModel(
-            model_path, 
-            device="cpu", 
-            compute_type="int8"
-        )
-
-        # Pyannote pipeline for speaker diarization (may require a pretrained model)
-        # You may need to specify the exact pipeline here, for example:
-        # pipeline = Pipeline.from_pretrained("pyannote/speaker-diarization")
-        # If you have a custom local pipeline:
-        diarization_model = os.getenv("DIARIZATION_MODEL", "pyannote/speaker-diarization")
-        self.diarization_pipeline = Pipeline.from_pretrained(diarization_model)
-
-        self.initialize_wav()
-
-    def initialize_wav(self):
-        if self.wav_writer is not None:
-            self.wav_writer.close()
-        self.audio_buffer = io.BytesIO()
-        self.wav_writer = wave.open(self.audio_buffer, 'wb')
-        self.wav_writer.setnchannels(1)
-        self.wav_writer.setsampwidth(2)
-        self.wav_writer.setframerate(self.sample_rate)
+        # Optional VAD deciding when to commit, otherwise commit_interval is used
+        self.segmenter = segmenter
+
+        # Tail of the previous window, diarized again as context for the next one
+        self.overlap_samples = int(overlap * sample_rate)
+        if 0 < overlap < REUSE_OVERLAP:
+            logging.warning(f"Overlap of {overlap}s is shorter than {REUSE_OVERLAP}s, "
+                            f"no frame embeddings can be reused between windows")
+        self.context = np.zeros(0, dtype=np.float32)
+        self.samples_committed = 0
+
+        # Models can be shared between processors, speaker state is per processor
+        if models is None:
+            models = Models()
+        self.selector = ModelSelector(models.whisper_models, max_lag=max_lag)
+        self.stream_start = None
+        self.samples_received = 0
+        self.transcribe_pool = models.transcribe_pool
+        self.diarizer = IncrementalDiarizer(models.pipeline, models.embedding, sample_rate,
+                                            threshold=speaker_threshold, lock=models.diarization_lock,
+                                            index=speaker_index)
+
+        # Transcriptions in flight, emitted strictly in submission order
+        self.pending = deque()
+        self.max_pending = models.workers * 4
+
+        # Low latency mode re-decoding the unconfirmed audio every partial_interval
+        self.streaming = None
+        if partial_interval:
+            self.streaming = StreamingTranscriber(self.selector, self.transcribe_pool, self.diarizer,
+                                                  sample_rate, emit, interval=partial_interval,
+                                                  word_timestamps=word_timestamps)
 
     def append_audio(self, audio_bytes: bytes):
-        self.wav_writer.writeframes(audio_bytes)
+        if self.stream_start is None:
+            self.stream_start = time.time()
+        self.samples_received += len(audio_bytes) // 2
+        if self.streaming is not None:
+            self.streaming.append(np.frombuffer(audio_bytes, dtype=np.int16).astype(np.float32) / 32768.0)
+        else:
+            self.audio_buffer.extend(audio_bytes)
+        if self.segmenter is not None:
+            self.segmenter.push(np.frombuffer(audio_bytes, dtype=np.int16))
+
+    def skip_audio_chunk(self):
+        # Silent window: nothing to diarize or transcribe, only advance the stream position
+        self.samples_committed += len(self.audio_buffer) // 2
+        self.context = self.context[:0]
+        self.audio_buffer = bytearray()
 
     def process_audio_chunk(self):
-        # Close writer to finalize the WAV
-        self.wav_writer.close()
-        raw_audio = self.audio_buffer.getvalue()
-
-        # Convert to numpy array and then to torch tensor for pyannote
-        with wave.open(io.BytesIO(raw_audio), 'rb') as wf:
-            n_samples = wf.getnframes()
-            audio_data = wf.readframes(n_samples)
-            audio_np = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
-            # Convert to torch tensor and reshape for pyannote (channels, samples)
-            audio_tensor = torch.from_numpy(audio_np).unsqueeze(0)
-
-        # Run speaker diarization with torch tensor
-        file = {"waveform": audio_tensor, "sample_rate": self.sample_rate}
-        diarization_result = self.diarization_pipeline(file)
-        # diarization_result is a pyannote.core.Annotation with speaker segments
-
-        # Now we have annotated speaker segments. We'll iterate over them,
-        # extract each segment, run STT on that segment, and print results.
-        # Sort by time
-        segments = list(diarization_result.itertracks(yield_label=True))
-        segments.sort(key=lambda x: x[0].start)
-
-        for segment, _, speaker in segments:
-            # Extract segment
-            start_sample = int(segment.start * self.sample_rate)
-            end_sample = int(segment.end * self.sample_rate)
-            segment_audio = audio_np[start_sample:end_sample]
+        new_audio = np.frombuffer(self.audio_buffer, dtype=np.int16).astype(np.float32) / 32768.0
+        self.audio_buffer = bytearray()
+
+        if len(new_audio) == 0:
+            return
+
+        # Diarize the new audio together with the overlap from the previous window;
+        # all positions below are absolute sample offsets since stream start
+        audio_np = np.concatenate([self.context, new_audio])
+        window_start = self.samples_committed - len(self.context)
+        new_start = self.samples_committed
+        segments = self.diarizer.diarize(audio_np, window_start, cache=self.cache)
+
+        # Only the part of each segment inside the new audio is transcribed,
+        # the overlap was already transcribed with the previous window
+        for start, end, speaker in segments:
+            start = max(start, new_start)
+            if end <= start:
+                continue
+            segment_audio = audio_np[start - window_start:end - window_start]
 
             if len(segment_audio) == 0:
                 continue
 
-            # Transcribe using faster-whisper
-            # Transcribe returns segments with text
-            # We'll just do a single call with the segment since it's short
-            # The model can handle numpy arrays directly if we provide them as float32.
-            # The whisper model's transcribe method typically expects a file, so we might need
-            # to pass raw audio. The faster-whisper's transcribe function can take a path
-            # or use `buffer` parameter. Let's write a small helper function that 
-            # transcribes from a numpy array.
+            future = self.transcribe_pool.submit(self.transcribe_array, segment_audio, start)
+            self.pending.append((future, speaker, start, end))
 
-            transcription = self.transcribe_array(segment_audio)
-            if transcription.strip():
-                # Print event in JSON
-                event = {
-                    "type": "pcmux.text.chunk",
-                    "speaker": speaker,
-                    "text": transcription
-                }
-                print(json.dumps(event))
-                sys.stdout.flush()
-
-        # Re-initialize for the next chunk
-        self.initialize_wav()
+        self.context = audio_np[-self.overlap_samples:] if self.overlap_samples > 0 else audio_np[:0]
+        self.samples_committed += len(new_audio)
 
-    def transcribe_array(self, audio_np: np.ndarray) -> str:
+    def transcribe_array(self, audio_np: np.ndarray, offset=0):
         # The faster-whisper model's transcribe expects a path or audio as array.
         # According to the documentation, we can pass NumPy arrays directly:
         # transcribe(self, audio: Union[str, np.ndarray], **kwargs)
         # We'll use a low latency approach by passing the raw array.
 
-        # We might want to use a small decoder options. If language is known, specify it.
-        segments, _ = self.whisper_model.transcribe(audio_np, beam_size=1, language="en")
-        # Combine text from all segments
-        text = " ".join([seg.text for seg in segments])
-        return text.strip()
+        level, name, beam_size = self.selector.current()
+        result = None
+        if self.cache is not None:
+            key = self.cache.key("transcribe", name, str(beam_size), str(self.word_timestamps),
+                                 str(self.sample_rate), audio_np.tobytes())
+            result = self.cache.get(key)
+
+        if result is None:
+            # We might want to use a small decoder options. If language is known, specify it.
+            segments = self.selector.transcribe(audio_np, self.sample_rate, level=level, language="en",
+                                                word_timestamps=self.word_timestamps)
+            # Combine text from all segments, word times relative to the segment
+            texts = []
+            words = []
+            for seg in segments:
+                texts.append(seg.text)
+                for word in seg.words or []:
+                    words.append({
+                        "word": word.word.strip(),
+                        "start": int(word.start * self.sample_rate),
+                        "end": int(word.end * self.sample_rate)
+                    })
+            result = {"text": " ".join(texts).strip(), "words": words}
+            if self.cache is not None:
+                self.cache.put(key, result)
+
+        # Word times become absolute sample offsets
+        words = [dict(word, start=offset + word["start"], end=offset + word["end"]) for word in result["words"]]
+        return result["text"], words
+
+    def emit_ready(self, wait=False):
+        # Emit finished transcriptions in order, waiting on the oldest if asked to
+        # or if too many are queued behind it
+        while self.pending:
+            future, speaker, start, end = self.pending[0]
+            if not (wait or future.done() or len(self.pending) > self.max_pending):
+                break
+            self.pending.popleft()
+            try:
+                transcription, words = future.result()
+            except Exception as e:
+                logging.error(f"Transcription failed: {e}")
+                continue
+            if transcription.strip():
+                event = {
+                    "type": "pcmux.text.chunk",
+                    "speaker": speaker,
+                    "text": transcription,
+                    "start": start,
+                    "end": end
+                }
+                if self.word_timestamps:
+                    event["words"] = words
+                self.emit(event)
+
+    def lag(self):
+        # Audio still waiting in the pipe plus committed audio not yet transcribed;
+        # audio buffered for the next commit is latency by design, not lag
+        if self.stream_start is None:
+            return 0.0
+        backlog = time.time() - self.stream_start - self.samples_received / self.sample_rate
+        if self.streaming is not None:
+            position = self.streaming.buffer_offset
+            committed = self.samples_received
+        else:
+            position = self.pending[0][2] if self.pending else self.samples_committed
+            committed = self.samples_committed
+        return max(backlog, 0.0) + (committed - position) / self.sample_rate
 
     def maybe_commit(self):
+        self.emit_ready()
+        self.selector.adjust(self.lag())
+        if self.streaming is not None:
+            # Text is confirmed continuously, pauses only end the current utterance
+            self.streaming.poll()
+            action = self.segmenter.poll() if self.segmenter is not None else None
+            if action == COMMIT:
+                self.streaming.finalize()
+            elif action == SKIP:
+                self.streaming.skip()
+            return
+
+        if self.segmenter is not None:
+            action = self.segmenter.poll()
+            if action == COMMIT:
+                self.process_audio_chunk()
+            elif action == SKIP:
+                self.skip_audio_chunk()
+            return
+
         current_time = time.time()
         if current_time - self.last_commit_time >= self.commit_interval:
             # Process current chunk
             self.process_audio_chunk()
             self.last_commit_time = current_time
 
+    def handle_message(self, message: dict):
+        mtype = message.get("type", "")
+        if mtype == "pcmux.audio.delta":
+            audio_b64 = message.get("delta", "")
+            if audio_b64:
+                audio_bytes = base64.b64decode(audio_b64)
+                self.append_audio(audio_bytes)
+                self.maybe_commit()
+        else:
+            # Ignore other message types or handle them if needed
+            pass
+
+    def finish(self):
+        if self.streaming is not None:
+            self.streaming.finalize()
+            return
+        if self.segmenter is not None and self.segmenter.flush() == SKIP:
+            self.skip_audio_chunk()
+        else:
+            self.process_audio_chunk()
+        self.emit_ready(wait=True)
+
+
+# Whisper model of an offline worker process
+offline_model = None
+
+
+def init_offline_worker(model_path, cpu_threads):
+    global offline_model
+    setup_logging()
+    offline_model = WhisperModel(model_path, device="cpu", compute_type="int8", cpu_threads=cpu_threads)
+
+
+def transcribe_offline_chunk(audio_np, offset, turns, beam_size, sample_rate, word_timestamps):
+    events = []
+    for start, end, speaker in turns:
+        segments, _ = offline_model.transcribe(audio_np[start - offset:end - offset], beam_size=beam_size,
+                                               language="en", word_timestamps=word_timestamps)
+        texts = []
+        words = []
+        for seg in segments:
+            texts.append(seg.text)
+            for word in seg.words or []:
+                words.append({
+                    "word": word.word.strip(),
+                    "start": start + int(word.start * sample_rate),
+                    "end": start + int(word.end * sample_rate)
+                })
+        text = " ".join(texts).strip()
+        if text:
+            event = {
+                "type": "pcmux.text.chunk",
+                "speaker": speaker,
+                "text": text,
+                "start": start,
+                "end": end
+            }
+            if word_timestamps:
+                event["words"] = words
+            events.append(event)
+    return events
+
+
+def split_at_silence(segments, max_samples):
+    # Group diarized turns into chunks, only cutting where no one is speaking
+    chunks = []
+    current = []
+    current_end = 0
+    for segment in segments:
+        if current and segment[0] >= current_end and segment[1] - current[0][0] > max_samples:
+            chunks.append(current)
+            current = []
+        current.append(segment)
+        current_end = max(current_end, segment[1])
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def transcribe_offline(args):
+    audio_np = read_all_audio(args.input, args.sample_rate)
+    logging.info(f"Read {len(audio_np) / args.sample_rate:.1f}s of audio")
+    if len(audio_np) == 0:
+        return
+
+    pipeline, embedding = load_diarization_models()
+    diarizer = IncrementalDiarizer(pipeline, embedding, args.sample_rate, threshold=args.speaker_threshold,
+                                   index=load_speaker_index(args.speakers, diarization_model_names()[1], args.known_threshold))
+    started = time.time()
+    segments = diarizer.diarize_full(audio_np)
+    logging.info(f"Diarized {len(segments)} turns in {time.time() - started:.1f}s")
+
+    chunks = split_at_silence(segments, int(args.max_window * args.sample_rate))
+    ladder = args.models or [(os.getenv("WHISPER_MODEL_PATH", "medium.en"), 1)]
+    model_path, beam_size = ladder[0]
+
+    # Spawned workers each load their own model, results come back in chunk order
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=init_offline_worker,
+                             initargs=(model_path, args.cpu_threads)) as executor:
+        futures = []
+        for turns in chunks:
+            start = turns[0][0]
+            end = max(turn[1] for turn in turns)
+            futures.append(executor.submit(transcribe_offline_chunk, audio_np[start:end], start, turns,
+                                           beam_size, args.sample_rate, args.word_timestamps))
+        for future in futures:
+            for event in future.result():
+                print_event(event)
+    logging.info(f"Transcribed {len(chunks)} chunks in {time.time() - started:.1f}s")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Local streaming transcription with pyannote for diarization and faster-whisper for STT.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
     parser.add_argument("-c", "--commit-interval", type=float, default=5.0,
-                        help="How often to commit audio buffer in seconds (default: 5.0)")
+                        help="How often to commit audio buffer in seconds with --vad none (default: 5.0)")
     parser.add_argument("--sample-rate", type=int, default=16000, help="Sample rate for processing audio")
+    parser.add_argument("--overlap", type=float, default=REUSE_OVERLAP,
+                        help=f"Seconds of the previous window re-diarized as context, shorter than the default "
+                             f"recomputes every frame embedding (default: {REUSE_OVERLAP})")
+    parser.add_argument("--speaker-threshold", type=float, default=0.5,
+                        help="Cosine similarity needed to match a known speaker (default: 0.5)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of segments transcribed in parallel (default: 1)")
+    parser.add_argument("--cpu-threads", type=int, default=0,
+                        help="CPU threads per transcription worker, 0 for the CTranslate2 default (default: 0)")
+    parser.add_argument("-p", "--partial", type=float, nargs="?", const=1.0, default=None, metavar="SECONDS",
+                        help="Stream pcmux.text.partial events, re-decoding every SECONDS (default: 1.0)")
+    parser.add_argument("--word-timestamps", action="store_true",
+                        help="Include per-word start/end offsets in pcmux.text.chunk events")
+    parser.add_argument("-m", "--models", type=parse_model_ladder, default=None,
+                        help="Whisper models to step down through when falling behind, largest first, "
+                             "e.g. medium.en:5,small.en,base.en (default: WHISPER_MODEL_PATH or medium.en)")
+    parser.add_argument("--max-lag", type=float, default=5.0,
+                        help="Seconds behind real time before switching to a smaller model (default: 5.0)")
+    parser.add_argument("--cache-dir", help="Cache diarization and transcription results for repeated audio in this directory")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Maximum cache size in MB (default: 1024)")
+    parser.add_argument("--speakers", help="Speaker index from enroll_speaker.py, matching speakers are reported by name")
+    parser.add_argument("--known-threshold", type=float, default=0.6,
+                        help="Cosine similarity needed to name a speaker from the index (default: 0.6)")
+    parser.add_argument("--offline", action="store_true",
+                        help="Read the whole stream first, diarize it once and transcribe chunks of up to "
+                             "--max-window seconds on a pool of --workers processes")
+    parser.add_argument("-i", "--input", help="With --offline, read this media file instead of stdin")
+    add_vad_arguments(parser)
     args = parser.parse_args()
 
-    processor = AudioProcessor(commit_interval=args.commit_interval, verbose=args.verbose, sample_rate=args.sample_rate)
+    setup_logging()
+    signal.signal(signal.SIGINT, signal_handler)
+
+    if args.offline:
+        transcribe_offline(args)
+        return
+
+    cache = ResultCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+
+    processor = AudioProcessor(commit_interval=args.commit_interval, verbose=args.verbose, sample_rate=args.sample_rate,
+                               overlap=args.overlap, speaker_threshold=args.speaker_threshold,
+                               segmenter=create_segmenter(args, args.sample_rate),
+                               models=Models(workers=args.workers, cpu_threads=args.cpu_threads, ladder=args.models),
+                               partial_interval=args.partial, word_timestamps=args.word_timestamps,
+                               max_lag=args.max_lag, cache=cache,
+                               speaker_index=load_speaker_index(args.speakers, diarization_model_names()[1], args.known_threshold))
 
     # Read from stdin line by line, expecting JSON messages with type "pcmux.audio.delta"
     for line in sys.stdin:
@@ -177,20 +641,12 @@ def main():
         except json.JSONDecodeError:
             logging.debug("Received non-JSON message.")
             continue
-
-        mtype = message.get("type", "")
-        if mtype == "pcmux.audio.delta":
-            audio_b64 = message.get("delta", "")
-            if audio_b64:
-                audio_bytes = base64.b64decode(audio_b64)
-                processor.append_audio(audio_bytes)
-                processor.maybe_commit()
-        else:
-            # Ignore other message types or handle them if needed
-            pass
+        processor.handle_message(message)
 
     # Final flush
-    processor.process_audio_chunk()
+    processor.finish()
+    if cache is not None:
+        logging.info(cache.stats())
 
 
 if __name__ == "__main__":
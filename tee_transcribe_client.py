@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import logging
+
+from pcmux_stdio import read_lines
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+DEFAULT_SOCKET = os.getenv("PCMUX_TRANSCRIBE_SOCKET", "/tmp/pcmux_transcribe.sock")
+
+
+async def forward_stdin(writer, session):
+    if session:
+        writer.write((json.dumps({"type": "pcmux.session.update", "session": session}) + "\n").encode())
+
+    async for line in read_lines():
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            logging.debug("Received non-JSON message.")
+            continue
+        # Only audio is needed by the server
+        if message.get("type") == "pcmux.audio.delta":
+            writer.write(line)
+            await writer.drain()
+
+    # Half-close so the server flushes the final window
+    writer.write_eof()
+
+
+async def print_results(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        sys.stdout.write(line.decode())
+        sys.stdout.flush()
+
+
+async def run(args, session):
+    try:
+        reader, writer = await asyncio.open_unix_connection(args.socket)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        logging.error(f"Could not connect to transcription server at {args.socket}: {e}")
+        sys.exit(1)
+
+    await asyncio.gather(forward_stdin(writer, session), print_results(reader))
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe through a running server_transcribe.py instead of loading models in-process.")
+    parser.add_argument("-s", "--socket", default=DEFAULT_SOCKET,
+                        help=f"Unix socket of the transcription server (default: {DEFAULT_SOCKET})")
+    # Unset options use the server defaults
+    parser.add_argument("-c", "--commit-interval", type=float, help="How often to commit audio buffer in seconds with --vad none")
+    parser.add_argument("--sample-rate", type=int, help="Sample rate for processing audio")
+    parser.add_argument("--overlap", type=float, help="Seconds of the previous window re-diarized as context")
+    parser.add_argument("--speaker-threshold", type=float, help="Cosine similarity needed to match a known speaker")
+    parser.add_argument("-p", "--partial", type=float, nargs="?", const=1.0, metavar="SECONDS",
+                        help="Stream pcmux.text.partial events, re-decoding every SECONDS (default: 1.0)")
+    parser.add_argument("--word-timestamps", action="store_true", default=None,
+                        help="Include per-word start/end offsets in pcmux.text.chunk events")
+    parser.add_argument("--max-lag", type=float, help="Seconds behind real time before switching to a smaller model")
+    parser.add_argument("--vad", choices=["energy", "silero", "none"], help="Commit at speech pauses using this VAD")
+    parser.add_argument("--min-window", type=float, help="Minimum seconds of audio per VAD commit")
+    parser.add_argument("--max-window", type=float, help="Maximum seconds of audio per VAD commit")
+    parser.add_argument("--min-silence", type=float, help="Pause length in seconds that ends a VAD commit")
+    args = parser.parse_args()
+
+    session = {key: value for key, value in vars(args).items() if key != "socket" and value is not None}
+
+    try:
+        asyncio.run(run(args, session))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
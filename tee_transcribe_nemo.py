@@ -6,17 +6,19 @@ import time
 import signal
 import argparse
 import base64
-import wave
 import logging
 
 import numpy as np
 import torch
+from omegaconf import OmegaConf
 from dotenv import load_dotenv
 load_dotenv()
 
 from faster_whisper import WhisperModel
 import nemo.collections.asr as nemo_asr
 from nemo.collections.asr.parts.utils.speaker_utils import perform_clustering
+from pcmux_vad import COMMIT, SKIP, add_vad_arguments, create_segmenter
+from pcmux_speakers import load_speaker_index
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='[%(levelname)s] %(message)s')
 interrupted = False
@@ -30,164 +32,194 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 class AudioProcessor:
-    def __init__(self, commit_interval=5.0, verbose=False):
+    def __init__(self, commit_interval=5.0, verbose=False, segmenter=None, speaker_index=None):
         self.commit_interval = commit_interval
+        self.speaker_index = speaker_index
+        self.segmenter = segmenter
         self.verbose = verbose
         if self.verbose:
             logging.getLogger().setLevel(logging.DEBUG)
         self.sample_rate = 16000
-        self.audio_buffer = b""
         self.last_commit_time = time.time()
+
+        # Preallocated sample buffer, grown by doubling when a window runs long
+        self.audio_buffer = np.zeros(30 * self.sample_rate, dtype=np.int16)
+        self.buffer_len = 0
+
+        # Frame VAD: speech probability per window, decided at the shift resolution
         self.vad_threshold = 0.5
-        self.manifest_file = "online_manifest.json"
+        self.vad_window = 0.63
+        self.vad_shift = 0.08
+        self.min_speech = 0.2
+        self.min_gap = 0.3
+
+        # Multiscale embedding windows in seconds, longest first, base scale last
+        self.scales = [1.5, 1.0, 0.5]
 
         model_path = os.getenv("WHISPER_MODEL_PATH", "medium.en")
         self.whisper_model = WhisperModel(model_path, device="cpu", compute_type="int8")
 
         # Load VAD and Speaker models
-        self.vad_model = nemo_asr.models.EncDecClassificationModel.from_pretrained("vad_multilingual_marblenet").to("cuda" if torch.cuda.is_available() else "cpu")
-        self.spk_model = nemo_asr.models.EncDecSpeakerLabelModel.from_pretrained("titanet_large").to("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.vad_model = nemo_asr.models.EncDecClassificationModel.from_pretrained("vad_multilingual_marblenet").to(self.device)
+        self.spk_model = nemo_asr.models.EncDecSpeakerLabelModel.from_pretrained("titanet_large").to(self.device)
         self.vad_model.eval()
         self.spk_model.eval()
 
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.AUDIO_RTTM_MAP = {}
+        self.clustering_params = OmegaConf.create({
+            "oracle_num_speakers": False,
+            "max_num_speakers": 8,
+            "enhanced_count_thres": 80,
+            "max_rp_threshold": 0.25,
+            "sparse_search_volume": 30,
+            "maj_vote_spk_count": False,
+            "chunk_cluster_count": 50,
+            "embeddings_per_chunk": 10000
+        })
         self.chunk_id = 0
 
     def append_audio(self, audio_bytes: bytes):
-        self.audio_buffer += audio_bytes
-
-    def create_manifest(self, audio_np: np.ndarray, chunk_id: int):
-        audio_file_name = f"audio_chunk_{chunk_id}.wav"
-        with wave.open(audio_file_name, "wb") as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(2)
-            wf.setframerate(self.sample_rate)
-            wf.writeframes((audio_np * 32768).astype(np.int16).tobytes())
-        meta = {
-            "audio_filepath": os.path.abspath(audio_file_name),
-            "offset": 0.0,
-            "duration": len(audio_np) / self.sample_rate
-        }
-        self.AUDIO_RTTM_MAP[f"audio_chunk_{chunk_id}"] = meta
-        # Write a single-entry manifest
-        with open(self.manifest_file, 'w') as f:
-            json.dump(meta, f)
-            f.write("\n")
-    
+        samples = np.frombuffer(audio_bytes, dtype=np.int16)
+        needed = self.buffer_len + len(samples)
+        if needed > len(self.audio_buffer):
+            grown = np.zeros(max(needed, 2 * len(self.audio_buffer)), dtype=np.int16)
+            grown[:self.buffer_len] = self.audio_buffer[:self.buffer_len]
+            self.audio_buffer = grown
+        self.audio_buffer[self.buffer_len:needed] = samples
+        self.buffer_len = needed
+        if self.segmenter is not None:
+            self.segmenter.push(samples)
+
+    def skip_audio_chunk(self):
+        self.buffer_len = 0
+
     def get_speech_segments(self, audio_np: np.ndarray):
-        # VAD expects (batch, time), we have a single segment so just [1, T]
-        audio_torch = torch.from_numpy(audio_np).float().to(self.vad_model.device)
-        audio_len = torch.tensor([audio_torch.shape[0]]).to(self.vad_model.device)
+        window = int(self.vad_window * self.sample_rate)
+        shift = int(self.vad_shift * self.sample_rate)
+        # Segments end at the real audio, padding only fills out the model input
+        duration = len(audio_np) / self.sample_rate
+        if len(audio_np) < window:
+            audio_np = np.pad(audio_np, (0, window - len(audio_np)))
 
+        # All VAD frames of the chunk go through the model as one batch
+        frames = np.lib.stride_tricks.sliding_window_view(audio_np, window)[::shift]
+        batch = torch.from_numpy(np.ascontiguousarray(frames)).float().to(self.device)
+        lengths = torch.full((len(frames),), window, dtype=torch.long, device=self.device)
         with torch.no_grad():
-            # The VAD model returns logits directly.
-            vad_res = self.vad_model(input_signal=audio_torch.unsqueeze(0), input_signal_length=audio_len)
-
-        logging.debug(f"VAD result: {vad_res}")
-        # vad_res shape is [1, 2], apply softmax to get speech probability
-        speech_prob = torch.softmax(vad_res, dim=-1)[0,1].item()
+            logits = self.vad_model(input_signal=batch, input_signal_length=lengths)
+        speech = (torch.softmax(logits, dim=-1)[:, 1] > self.vad_threshold).cpu().numpy()
+        logging.debug(f"VAD: {int(speech.sum())}/{len(speech)} speech frames")
 
+        # Each frame decides the shift-long slice around its center
         segments = []
-        if speech_prob > self.vad_threshold:
-            # If above threshold, consider the entire chunk as speech
-            segments.append((0, len(audio_np) / self.sample_rate))
-        return segments
+        edges = np.flatnonzero(np.diff(np.concatenate([[False], speech, [False]]).astype(np.int8)))
+        center = (window - shift) / 2
+        for first, last in zip(edges[::2], edges[1::2]):
+            start = 0.0 if first == 0 else (first * shift + center) / self.sample_rate
+            end = duration if last == len(speech) else min((last * shift + center) / self.sample_rate, duration)
+            if segments and start - segments[-1][1] < self.min_gap:
+                segments[-1] = (segments[-1][0], end)
+            else:
+                segments.append((start, end))
+        return [(start, end) for start, end in segments if end - start >= self.min_speech]
 
-    def process_audio_chunk(self):
-        if not self.audio_buffer:
-            return
-        try:
-            audio_np = np.frombuffer(self.audio_buffer, dtype=np.int16).astype(np.float32) / 32768.0
-        except ValueError as e:
-            logging.error(f"Error decoding audio buffer: {e}")
-            self.audio_buffer = b""
-            return
+    def extract_multiscale_embeddings(self, audio_np: np.ndarray, segments):
+        timestamps = []
+        counts = []
+        for window in self.scales:
+            shift = window / 2
+            scale_count = 0
+            for start, end in segments:
+                t = start
+                while True:
+                    timestamps.append((t, min(t + window, end)))
+                    scale_count += 1
+                    if t + window >= end:
+                        break
+                    t += shift
+            counts.append(scale_count)
+
+        # Every subsegment of every scale in a single padded forward pass
+        lengths = [max(min(int((end - start) * self.sample_rate), len(audio_np) - int(start * self.sample_rate)), 1)
+                   for start, end in timestamps]
+        batch = torch.zeros((len(timestamps), max(lengths)), dtype=torch.float32)
+        for i, (start, end) in enumerate(timestamps):
+            first = int(start * self.sample_rate)
+            batch[i, :lengths[i]] = torch.from_numpy(audio_np[first:first + lengths[i]])
+        with torch.no_grad():
+            _, embeddings = self.spk_model(input_signal=batch.to(self.device),
+                                           input_signal_length=torch.tensor(lengths, device=self.device))
+
+        return {
+            "embeddings": embeddings.cpu(),
+            "timestamps": torch.tensor(timestamps, dtype=torch.float32),
+            "multiscale_segment_counts": torch.tensor(counts),
+            "multiscale_weights": torch.ones(1, len(self.scales)) / len(self.scales)
+        }
+
+    def known_speakers(self, annotation, embs_and_timestamps):
+        # Centroid of the base scale embeddings per cluster, matched against the index
+        base_count = int(embs_and_timestamps["multiscale_segment_counts"][-1])
+        embeddings = embs_and_timestamps["embeddings"][-base_count:].numpy()
+        timestamps = embs_and_timestamps["timestamps"][-base_count:].numpy()
+        mids = timestamps.mean(axis=1)
 
-        if len(audio_np) == 0:
-            self.audio_buffer = b""
+        labels = annotation.labels()
+        centroids = []
+        for label in labels:
+            turns = np.array([(segment.start, segment.end) for segment in annotation.label_timeline(label)])
+            inside = ((mids[:, None] >= turns[None, :, 0]) & (mids[:, None] < turns[None, :, 1])).any(axis=1)
+            centroids.append(embeddings[inside].mean(axis=0) if inside.any() else np.zeros(embeddings.shape[1]))
+        names = self.speaker_index.match(np.stack(centroids)) if labels else []
+        return {label: name for label, name in zip(labels, names) if name}
+
+    def process_audio_chunk(self):
+        if self.buffer_len == 0:
             return
+        audio_np = self.audio_buffer[:self.buffer_len].astype(np.float32) / 32768.0
+        self.buffer_len = 0
 
-        self.create_manifest(audio_np, self.chunk_id)
         segments = self.get_speech_segments(audio_np)
         if not segments:
             # No speech detected
-            self.audio_buffer = b""
             self.chunk_id += 1
             return
 
-        # Extract speaker embeddings
-        embeddings = {f"audio_chunk_{self.chunk_id}": []}
-        timestamps = {f"audio_chunk_{self.chunk_id}": []}
-
-        meta = self.AUDIO_RTTM_MAP[f"audio_chunk_{self.chunk_id}"]
-        start_sample = int(meta['offset'] * self.sample_rate)
-        end_sample = int((meta['offset'] + meta['duration']) * self.sample_rate)
-        seg_audio = audio_np[start_sample:end_sample]
-
-        if len(seg_audio) > 0:
-            # Speaker model expects shape [B, T]
-            audio_torch = torch.from_numpy(seg_audio).float().to(self.spk_model.device).unsqueeze(0)
-            audio_len = torch.tensor([audio_torch.shape[-1]]).to(self.spk_model.device)
-
-            with torch.no_grad():
-                # The speaker model returns a tuple of (logits, embeddings)
-                spk_model_output = self.spk_model(input_signal=audio_torch, input_signal_length=audio_len)
-                logging.debug(f"Speaker model: {spk_model_output}")
-                emb = spk_model_output[1].cpu().numpy()  # Use the second tensor (embeddings)
-
-            embeddings[f"audio_chunk_{self.chunk_id}"].append(emb[0])
-            timestamps[f"audio_chunk_{self.chunk_id}"].append([meta['offset'], meta['offset'] + meta['duration']])
-
-        if len(embeddings[f"audio_chunk_{self.chunk_id}"]) > 0:
-            embeddings_array = np.concatenate(embeddings[f"audio_chunk_{self.chunk_id}"], axis=0)
-            timestamps_array = np.array(timestamps[f"audio_chunk_{self.chunk_id}"])
-            embs_and_timestamps = {
-                f"audio_chunk_{self.chunk_id}": {
-                    'embeddings': torch.from_numpy(embeddings_array),
-                    'timestamps': torch.from_numpy(timestamps_array),
-                    'multiscale_segment_counts': torch.tensor([len(embeddings[f"audio_chunk_{self.chunk_id}"])])
-                }
-            }
-        else:
-            embs_and_timestamps = {}
-
-        # Perform clustering and transcription if we have embeddings
-        if embs_and_timestamps:
-            all_reference, all_hypothesis = perform_clustering(
-                embs_and_timestamps=embs_and_timestamps,
-                AUDIO_RTTM_MAP=self.AUDIO_RTTM_MAP,
-                out_rttm_dir=None,
-                clustering_params={
-                    "max_num_speakers": 8,
-                    "oracle_num_speakers": False,
-                    "max_rp_threshold": 0.9,
-                    "sparse_search_volume": 30,
-                    "enhance_count_threshold": 3
-                },
-                device=torch.device(self.device),
-                verbose=self.verbose
-            )
-
-            for uniq_id, annotation in all_hypothesis:
-                for segment, speaker in annotation.itertracks(yield_label=True):
-                    start_sample = int(segment.start * self.sample_rate)
-                    end_sample = int(segment.end * self.sample_rate)
-                    segment_audio = audio_np[start_sample:end_sample]
-                    # Skip very short segments
-                    if len(segment_audio) < self.sample_rate * 0.1:
-                        continue
-                    transcription = self.transcribe_array(segment_audio)
-                    if transcription.strip():
-                        event = {
-                            "type": "pcmux.text.chunk",
-                            "speaker": speaker,
-                            "text": transcription
-                        }
-                        print(json.dumps(event))
-                        sys.stdout.flush()
-
-        self.audio_buffer = b""
+        # Everything stays in memory, the RTTM map only describes this chunk
+        uniq_id = f"audio_chunk_{self.chunk_id}"
+        audio_rttm_map = {uniq_id: {"offset": 0.0, "duration": len(audio_np) / self.sample_rate}}
+        embs_and_timestamps = {uniq_id: self.extract_multiscale_embeddings(audio_np, segments)}
+
+        all_reference, all_hypothesis = perform_clustering(
+            embs_and_timestamps=embs_and_timestamps,
+            AUDIO_RTTM_MAP=audio_rttm_map,
+            out_rttm_dir=None,
+            clustering_params=self.clustering_params,
+            device=torch.device(self.device),
+            verbose=self.verbose
+        )
+
+        for uniq_id, annotation in all_hypothesis:
+            names = {}
+            if self.speaker_index is not None:
+                names = self.known_speakers(annotation, embs_and_timestamps[uniq_id])
+            for segment, _, speaker in annotation.itertracks(yield_label=True):
+                start_sample = int(segment.start * self.sample_rate)
+                end_sample = int(segment.end * self.sample_rate)
+                segment_audio = audio_np[start_sample:end_sample]
+                # Skip very short segments
+                if len(segment_audio) < self.sample_rate * 0.1:
+                    continue
+                transcription = self.transcribe_array(segment_audio)
+                if transcription.strip():
+                    event = {
+                        "type": "pcmux.text.chunk",
+                        "speaker": names.get(speaker, speaker),
+                        "text": transcription
+                    }
+                    print(json.dumps(event))
+                    sys.stdout.flush()
+
         self.chunk_id += 1
 
     def transcribe_array(self, audio_np: np.ndarray) -> str:
@@ -195,6 +227,13 @@ class AudioProcessor:
         return " ".join([seg.text for seg in segments]).strip()
 
     def maybe_commit(self):
+        if self.segmenter is not None:
+            action = self.segmenter.poll()
+            if action == COMMIT:
+                self.process_audio_chunk()
+            elif action == SKIP:
+                self.skip_audio_chunk()
+            return
         # Commit at intervals to process buffered audio
         if time.time() - self.last_commit_time >= self.commit_interval:
             self.process_audio_chunk()
@@ -204,10 +243,16 @@ def main():
     parser = argparse.ArgumentParser(description="Local streaming transcription.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
     parser.add_argument("-c", "--commit-interval", type=float, default=5.0,
-                        help="How often to commit audio buffer in seconds (default: 5.0)")
+                        help="How often to commit audio buffer in seconds with --vad none (default: 5.0)")
+    parser.add_argument("--speakers", help="Speaker index from enroll_speaker.py --backend titanet")
+    parser.add_argument("--known-threshold", type=float, default=0.6,
+                        help="Cosine similarity needed to name a speaker from the index (default: 0.6)")
+    add_vad_arguments(parser)
     args = parser.parse_args()
 
-    processor = AudioProcessor(commit_interval=args.commit_interval, verbose=args.verbose)
+    processor = AudioProcessor(commit_interval=args.commit_interval, verbose=args.verbose,
+                               segmenter=create_segmenter(args, 16000),
+                               speaker_index=load_speaker_index(args.speakers, "titanet_large", args.known_threshold))
     for line in sys.stdin:
         if interrupted:
             break
@@ -225,7 +270,10 @@ def main():
                 processor.append_audio(base64.b64decode(audio_b64))
                 processor.maybe_commit()
     # Process any remaining audio after the loop
-    processor.process_audio_chunk()
+    if processor.segmenter is not None and processor.segmenter.flush() == SKIP:
+        processor.skip_audio_chunk()
+    else:
+        processor.process_audio_chunk()
 
 if __name__ == "__main__":
     main()